@@ -1,5 +1,20 @@
 const Channel = require("../models/channelSchema");
 
+// Every lookup of a pending channel moves it this many seconds ahead in the categorization queue
+const REQUEST_BOOST_SECONDS = Number(process.env.REQUEST_BOOST_SECONDS || 3600);
+
+// Record demand for channels still waiting to be categorized, the cron job drains them by queue_rank
+async function bumpDemand(channelIds) {
+  if (channelIds.length === 0) return;
+  await Channel.updateMany(
+    { _id: { $in: channelIds }, status: 0 },
+    {
+      $inc: { request_count: 1, queue_rank: -REQUEST_BOOST_SECONDS },
+      $set: { last_requested_at: new Date() },
+    }
+  );
+}
+
 async function getChannelCategory(req, res) {
   try {
     console.log("yt controller:: ", req.body.length);
@@ -21,7 +36,15 @@ async function getChannelCategory(req, res) {
     }));
 
     // Query MongoDB in bulk
-    const foundChannels = await Channel.find({ $or: filters }).lean();
+    const foundChannels = await Channel.find(
+      { $or: filters },
+      { channel_handle: 1, channel_name: 1, channel_categories: 1, status: 1 }
+    ).lean();
+
+    // not awaited, demand tracking must not add a write to the lookup latency
+    bumpDemand(
+      foundChannels.filter((doc) => doc.status === 0).map((doc) => doc._id)
+    ).catch((error) => console.error("Error recording channel demand:", error));
 
     // TODO: Need to check if it is returning an arr of channel categories
     // Create a map for quick lookup by compound key 'channel_id|channel_name'
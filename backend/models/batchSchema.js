@@ -4,7 +4,10 @@ const batchSchema = new mongoose.Schema(
   {
     file_id: { type: String, required: true },          
     batch_id: { type: String, required: true },         
-    status: { type: Number, default: 0, enum: [0, 1] },
+    status: { type: Number, default: 0, enum: [0, 1, 2] },
+    input_file: { type: String },
+    retries: { type: Number, default: 0 },
+    next_check_at: { type: Number },
     timestamp: { type: Date, default: Date.now }   
   },
   { versionKey: false }
@@ -4,14 +4,21 @@ const channelSchema = new mongoose.Schema(
   {
     channel_name: { type: String, required: true },
     channel_handle: { type: String, required: true },
-    videos: { type: Array, default: [] },
+    latest_video: { video_id: String, published_at: String }, // videos themselves live in channel_videos
     channel_categories: {
       type: [Number],
       enum: [-1, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
       default: [-1],
     },
     status: { type: Number, default: 0, enum: [0, 1, 2] },
+    // categorization queue order (lower first): insert time in seconds, pulled ahead by user demand
+    queue_rank: { type: Number, default: () => Date.now() / 1000 },
+    request_count: { type: Number, default: 0 },
+    last_requested_at: { type: Date },
     channel_id: { type: String },
+    video_count: { type: Number },
+    categorized_at: { type: Number },
+    refresh_checked_at: { type: Number },
     timestamp: { type: Date, default: Date.now },
   },
   { versionKey: false }
@@ -19,5 +26,11 @@ const channelSchema = new mongoose.Schema(
 
 channelSchema.index({ channel_name: 1 }, { unique: true });
 channelSchema.index({ channel_handle: 1 }, { unique: true });
+channelSchema.index({ status: 1, lease_until: 1 });
+// ranking index, only covers the pending backlog
+channelSchema.index(
+  { queue_rank: 1 },
+  { partialFilterExpression: { status: 0 } }
+);
 
 module.exports = mongoose.model("Channel", channelSchema);
@@ -0,0 +1,502 @@
+"""
+Offline benchmark for run_script.py.
+
+Runs execute_new_jobs, update_running_jobs and update_channel_database against local stand-ins for
+the YouTube data api, the groq files/batches api and MongoDB (mongomock in memory, or a local mongod
+via --mongo-url) on a synthetic backlog, no keys or network needed. Reports per stage throughput,
+p50/p99 latency, peak RSS and api call counts as json.
+
+Usage:
+    python benchmark.py --channels 1000
+    python benchmark.py --channels 100000 --yt-latency 0.08 --error-rate 0.01 --output bench.json
+    python benchmark.py --channels 1000 --groq-error-rate 0.2     # failed uploads, batch creates and polls
+    python benchmark.py --channels 1000 --baseline bench.json   # exit 1 on a throughput regression
+    python benchmark.py --lookup --channels 100000 --mongo-url mongodb://localhost   # snapshot vs mongo lookups
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+from types import SimpleNamespace
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class Recorder:
+    """Thread safe latency samples keyed by name (api endpoint or pipeline stage)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.items = {}
+
+    def record(self, name, seconds, items=1):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            self.items[name] = self.items.get(name, 0) + items
+
+    def summary(self):
+        report = {}
+        for name, samples in sorted(self.samples.items()):
+            total = sum(samples)
+            report[name] = {
+                "calls": len(samples),
+                "items": self.items[name],
+                "total_s": round(total, 4),
+                "p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "p99_ms": round(percentile(samples, 99) * 1000, 3),
+                "items_per_s": round(self.items[name] / total, 1) if total else None,
+            }
+        return report
+
+
+class FakeApi:
+    """Latency and error injection shared by the fakes"""
+
+    def __init__(self, recorder, latency, error_rate, seed):
+        self.recorder = recorder
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def call(self, endpoint, respond):
+        started = time.perf_counter()
+        with self.lock:
+            jitter = self.random.uniform(0.5, 1.5)
+            fail = self.random.random() < self.error_rate
+        time.sleep(self.latency * jitter)
+        self.recorder.record(endpoint, time.perf_counter() - started)
+
+        if fail:
+            self.fail(endpoint)
+        return respond()
+
+    def fail(self, endpoint):
+        raise Exception(f"injected error in {endpoint}")
+
+
+# ---------------------------------------------------------------- youtube
+
+def channel_id(n):
+    return f"UC{n:022d}"
+
+
+def channel_item(n):
+    return {
+        "id": channel_id(n),
+        "etag": f"etag-{n}",
+        "snippet": {"title": f"Channel {n}", "description": f"Synthetic channel number {n} about topic {n % 8}", "publishedAt": "2020-01-01T00:00:00Z"},
+        "statistics": {"viewCount": "1000", "subscriberCount": "100", "videoCount": str(40 + n % 80)},
+        "contentDetails": {"relatedPlaylists": {"uploads": f"UU{n:022d}"}},
+        "brandingSettings": {},
+    }
+
+
+class FakeYouTubeRequest:
+    def __init__(self, api, endpoint, params, respond):
+        self.api = api
+        self.endpoint = endpoint
+        self.uri = f"https://youtube.local/youtube/v3/{endpoint}?" + "&".join(f"{k}={v}" for k, v in sorted(params.items()) if v is not None)
+        self.headers = {}
+        self.respond = respond
+
+    def execute(self, http=None, num_retries=0):
+        return self.api.call(f"youtube.{self.endpoint}", self.respond)
+
+
+class FakeYouTubeApi(FakeApi):
+    def fail(self, endpoint):
+        from googleapiclient.errors import HttpError
+        import httplib2
+        content = json.dumps({"error": {"errors": [{"reason": "rateLimitExceeded"}]}}).encode()
+        raise HttpError(httplib2.Response({"status": 429}), content)
+
+
+class FakeYouTube:
+    """channels().list and playlistItems().list of the youtube data api over synthetic channels"""
+
+    def __init__(self, api, num_channels, videos_per_channel):
+        self.api = api
+        self.num_channels = num_channels
+        self.videos_per_channel = videos_per_channel
+
+    def channels(self):
+        return SimpleNamespace(list=self._channels_list)
+
+    def playlistItems(self):
+        return SimpleNamespace(list=self._playlist_items_list)
+
+    def _channels_list(self, part=None, id=None, forHandle=None, forUsername=None, maxResults=None):
+        def respond():
+            if forHandle is not None:
+                numbers = [int(forHandle.replace("chan", ""))]
+            else:
+                numbers = [int(channel_id_[2:]) for channel_id_ in (id or "").split(",") if channel_id_]
+            return {"items": [channel_item(n) for n in numbers if n < self.num_channels]}
+
+        params = {"part": part, "id": id, "forHandle": forHandle, "forUsername": forUsername, "maxResults": maxResults}
+        return FakeYouTubeRequest(self.api, "channels", params, respond)
+
+    def _playlist_items_list(self, part=None, playlistId=None, maxResults=50, pageToken=None):
+        def respond():
+            n = int(playlistId[2:])
+            start = int(pageToken or 0)
+            end = min(start + maxResults, self.videos_per_channel)
+            items = [
+                {"snippet": {
+                    "resourceId": {"videoId": f"v{n}-{i}"},
+                    "title": f"Video {i} of channel {n} about topic {n % 8}",
+                    "description": "",
+                    "publishedAt": f"2024-01-01T00:00:{59 - i % 60:02d}Z",
+                    "thumbnails": {"medium": {"url": "https://example.invalid/t.jpg"}},
+                    "channelTitle": f"Channel {n}",
+                }}
+                for i in range(start, end)
+            ]
+            response = {"items": items, "etag": f"p{n}-{start}"}
+            if end < self.videos_per_channel:
+                response["nextPageToken"] = str(end)
+            return response
+
+        params = {"part": part, "playlistId": playlistId, "maxResults": maxResults, "pageToken": pageToken}
+        return FakeYouTubeRequest(self.api, "playlistItems", params, respond)
+
+
+# ---------------------------------------------------------------- groq
+
+class FakeGroqOutput:
+    def __init__(self, lines):
+        self.lines = lines
+
+    def write_to_file(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(self.lines)
+
+
+class FakeCompletion:
+    def __init__(self, body):
+        self.body = body
+
+    def model_dump(self):
+        return self.body
+
+
+class FakeGroq:
+    """
+    files.create/content and batches.create/retrieve of the groq batch api, batches complete instantly,
+    and chat.completions.create for the sync mode
+    """
+
+    def __init__(self, api, seed):
+        self.api = api
+        self.random = random.Random(seed)
+        self.uploaded = {}
+        self.batches_by_id = {}
+        self.lock = threading.Lock()
+        self.files = SimpleNamespace(create=self._files_create, content=self._files_content)
+        self.batches = SimpleNamespace(create=self._batches_create, retrieve=self._batches_retrieve)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_completions_create))
+
+    def _completion_body(self, messages):
+        user = messages[1]["content"]
+        content = {"channel_name": user.split("\n", 1)[0].replace("Channel name: ", ""), "categories": [self.random.randint(0, 7)]}
+        return {"choices": [{"message": {"content": json.dumps(content)}}]}
+
+    def _new_id(self, prefix):
+        with self.lock:
+            return f"{prefix}_{len(self.uploaded) + len(self.batches_by_id)}_{self.random.getrandbits(32):08x}"
+
+    def _files_create(self, file, purpose):
+        data = file[1] if isinstance(file, tuple) else file.read()   # (name, content) like the groq sdk accepts
+
+        def respond():
+            file_id = self._new_id("file")
+            self.uploaded[file_id] = data
+            return SimpleNamespace(id=file_id)
+        return self.api.call("groq.files.create", respond)
+
+    def _batches_create(self, completion_window, endpoint, input_file_id):
+        def respond():
+            batch_id = self._new_id("batch")
+            self.batches_by_id[batch_id] = input_file_id
+            return SimpleNamespace(id=batch_id)
+        return self.api.call("groq.batches.create", respond)
+
+    def _batches_retrieve(self, batch_id):
+        def respond():
+            total = self.uploaded[self.batches_by_id[batch_id]].count(b"\n")
+            body = {
+                "id": batch_id,
+                "status": "completed",
+                "output_file_id": f"out_{batch_id}",
+                "request_counts": {"total": total, "completed": total, "failed": 0},
+            }
+            return SimpleNamespace(to_json=lambda: json.dumps(body))
+        return self.api.call("groq.batches.retrieve", respond)
+
+    def _files_content(self, output_file_id):
+        def respond():
+            lines = []
+            for line in self.uploaded[self.batches_by_id[output_file_id[4:]]].splitlines():
+                request = json.loads(line)
+                lines.append(json.dumps({
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": self._completion_body(request["body"]["messages"])},
+                }) + "\n")
+            return FakeGroqOutput(lines)
+        return self.api.call("groq.files.content", respond)
+
+    def _chat_completions_create(self, messages, **kwargs):
+        return self.api.call("groq.chat.completions.create", lambda: FakeCompletion(self._completion_body(messages)))
+
+
+# ---------------------------------------------------------------- harness
+
+def seed_backlog(db, num_channels, handle_ratio, seed):
+    """
+    num_channels status 0 channels, handle_ratio of them referenced by @handle and the rest by channel id.
+    Demand is long tailed like real lookups, queue_rank as the backend would have left it.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    docs = []
+    for n in range(num_channels):
+        handle = f"@chan{n}" if rng.random() < handle_ratio else channel_id(n)
+        requests = int(rng.paretovariate(1.2)) - 1
+        docs.append({
+            "channel_name": f"Channel {n}", "channel_handle": handle, "channel_categories": [-1], "status": 0,
+            "request_count": requests, "queue_rank": now - n - requests * 3600,
+        })
+        if len(docs) == 10000:
+            db["channels"].insert_many(docs)
+            docs = []
+    if docs:
+        db["channels"].insert_many(docs)
+
+
+def instrument(module, recorder, names):
+    """Wrap module level functions so every call is timed under stage.<name>"""
+    for name in names:
+        original = getattr(module, name)
+
+        def timed(*args, __original=original, __name=name, **kwargs):
+            started = time.perf_counter()
+            try:
+                return __original(*args, **kwargs)
+            finally:
+                items = len(args[0]) if __name == "fetch_channels" and args else 1
+                recorder.record(f"stage.{__name}", time.perf_counter() - started, items)
+
+        setattr(module, name, timed)
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="shutup-bench-")
+    os.chdir(workdir)   # run_script writes ./data
+    os.environ.update({
+        "DB_NAME": args.db_name,
+        "YOUTUBE_API_KEY": "offline",
+        "GROQ_API": "offline",
+        "YT_CACHE": "0",
+        "FAST_CLASSIFIER": "0",
+        "YT_QUOTA_PER_SECOND": "1000000",
+        "YT_DAILY_QUOTA": str(10 ** 9),
+        "GROQ_MODE": args.groq_mode,
+        "GROQ_SYNC_RPM": str(10 ** 6),
+        "GROQ_SYNC_TPM": str(10 ** 9),
+    })
+
+    recorder = Recorder()
+    youtube = FakeYouTube(FakeYouTubeApi(recorder, args.yt_latency, args.error_rate, args.seed), args.channels, args.videos)
+    groq = FakeGroq(FakeApi(recorder, args.groq_latency, args.groq_error_rate, args.seed), args.seed)
+
+    if args.mongo_url:
+        import pymongo
+        mongo = pymongo.MongoClient(args.mongo_url)
+    else:
+        import mongomock
+        mongo = mongomock.MongoClient()
+    mongo.drop_database(args.db_name)
+
+    sys.path.insert(0, SCRIPT_DIR)
+    import run_script
+
+    # clients are built lazily, hand run_script the stand-ins before anything touches them
+    run_script.youtube.instance = youtube
+    run_script.groq_client.instance = groq
+    run_script.client.instance = mongo
+    run_script.db.instance = mongo[args.db_name]
+
+    # mongomock reads MONGODB as the server version it emulates, don't let a .env picked up by run_script leak into it
+    if not args.mongo_url:
+        os.environ.pop("MONGODB", None)
+
+    instrument(run_script, recorder, [
+        "fetch_channels", "write_to_batch_file", "submit_task",
+        "check_batch", "update_channel_database", "ingest_results_file",
+    ])
+
+    db = mongo[args.db_name]
+    started = time.perf_counter()
+    seed_backlog(db, args.channels, args.handle_ratio, args.seed)
+    recorder.record("mongo.seed_backlog", time.perf_counter() - started, args.channels)
+
+    jobs = {}
+    for name, job in (("execute_new_jobs", run_script.execute_new_jobs), ("update_running_jobs", run_script.update_running_jobs)):
+        started = time.perf_counter()
+        job()
+        jobs[name] = round(time.perf_counter() - started, 3)
+
+    statuses = {str(status): db["channels"].count_documents({"status": status}) for status in (0, 1, 2)}
+    report = {
+        "config": vars(args),
+        "jobs_s": jobs,
+        "channels_per_minute": round(args.channels / max(sum(jobs.values()), 1e-9) * 60, 1),
+        "channel_status": statuses,
+        "youtube_quota_used": run_script.yt_quota.used,
+        "peak_rss_mb": peak_rss_mb(),
+        "timings": recorder.summary(),
+        "run_metrics": run_script.metrics.summary(),
+    }
+    return report
+
+
+def lookup_benchmark(args):
+    """
+    Lookup throughput of the category snapshot against the backend's getChannelCategory query ($or over
+    handle/name pairs, one query per page of channels) on args.channels categorized channels. Needs a
+    real mongod, mongomock answers the query with a python loop over every doc.
+    """
+    workdir = tempfile.mkdtemp(prefix="shutup-bench-")
+    sys.path.insert(0, SCRIPT_DIR)
+    import category_snapshot
+    import pymongo
+
+    mongo = pymongo.MongoClient(args.mongo_url)
+    mongo.drop_database(args.db_name)
+    collection = mongo[args.db_name]["channels"]
+    # the backend's unique indexes
+    collection.create_index("channel_name", unique=True)
+    collection.create_index("channel_handle", unique=True)
+
+    rng = random.Random(args.seed)
+    for start in range(0, args.channels, 10000):
+        collection.insert_many([
+            {"channel_name": f"Channel {n}", "channel_handle": f"@chan{n}", "status": 2,
+             "channel_categories": rng.sample(range(8), rng.randint(1, 3)), "categorized_at": time.time()}
+            for n in range(start, min(start + 10000, args.channels))
+        ])
+
+    started = time.perf_counter()
+    snapshot, _ = category_snapshot.build(collection, os.path.join(workdir, "snapshots"))
+    build_s = time.perf_counter() - started
+
+    # pages of channels like the extension sends them, a share of them not categorized
+    pages = [
+        [(f"@chan{n}", f"Channel {n}") for n in (rng.randrange(int(args.channels * 1.1)) for _ in range(args.page_size))]
+        for _ in range(args.pages)
+    ]
+    lookups = args.pages * args.page_size
+
+    started = time.perf_counter()
+    for page in pages:
+        list(collection.find(
+            {"$or": [{"channel_handle": handle, "channel_name": name} for handle, name in page]},
+            {"channel_handle": 1, "channel_name": 1, "channel_categories": 1},
+        ))
+    mongo_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for page in pages:
+        snapshot.lookup_many(page)
+    snapshot_s = time.perf_counter() - started
+
+    return {
+        "config": vars(args),
+        "snapshot_build_s": round(build_s, 3),
+        "snapshot_bytes": os.path.getsize(snapshot.path),
+        "mongo_lookups_per_s": round(lookups / mongo_s, 1),
+        "snapshot_lookups_per_s": round(lookups / snapshot_s, 1),
+        "speedup": round(mongo_s / snapshot_s, 1),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Names of regressions against a previous report"""
+    regressions = []
+    if report["channels_per_minute"] < baseline["channels_per_minute"] * (1 - tolerance):
+        regressions.append(f"channels_per_minute {report['channels_per_minute']} < {baseline['channels_per_minute']}")
+    for name, seconds in baseline["jobs_s"].items():
+        if report["jobs_s"].get(name, 0) > seconds * (1 + tolerance):
+            regressions.append(f"{name} took {report['jobs_s'][name]}s (baseline {seconds}s)")
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the categorization pipeline")
+    parser.add_argument("--channels", type=int, default=1000, help="synthetic backlog size")
+    parser.add_argument("--videos", type=int, default=60, help="uploads per synthetic channel")
+    parser.add_argument("--handle-ratio", type=float, default=0.5, help="share of channels referenced by @handle")
+    parser.add_argument("--yt-latency", type=float, default=0.05, help="seconds per youtube call")
+    parser.add_argument("--groq-latency", type=float, default=0.2, help="seconds per groq call")
+    parser.add_argument("--groq-mode", choices=("batch", "sync", "auto"), default="batch", help="groq batch api or sync chat completions")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of youtube calls answered with 429")
+    parser.add_argument("--groq-error-rate", type=float, default=0.0, help="share of groq files/batches/chat calls that fail")
+    parser.add_argument("--mongo-url", help="local mongod to use instead of in memory mongomock (mongomock needs pymongo<4.9)")
+    parser.add_argument("--db-name", default="shutup_benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lookup", action="store_true", help="benchmark category snapshot lookups against the mongo query instead (needs --mongo-url)")
+    parser.add_argument("--pages", type=int, default=1000, help="lookup benchmark: pages looked up")
+    parser.add_argument("--page-size", type=int, default=20, help="lookup benchmark: channels per page")
+    parser.add_argument("--output", help="also write the json report to this file")
+    parser.add_argument("--baseline", help="previous json report, exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+    if args.lookup and not args.mongo_url:
+        # mongomock's $or is a pure python scan, the speedup against it says nothing about the backend's query
+        parser.error("--lookup needs --mongo-url, mongomock lookup numbers are not comparable to a real mongod")
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = json.load(open(args.baseline)) if args.baseline else None
+
+    report = lookup_benchmark(args) if args.lookup else run(args)
+    print(json.dumps(report, indent=2))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline and not args.lookup:
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
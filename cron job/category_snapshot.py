@@ -0,0 +1,208 @@
+"""
+Compact category snapshot for the lookup path.
+
+A snapshot maps the backend's lookup key `channel_handle|channel_name` (hashed to 64 bits) to a bitmask
+of the channel's categories. It is a flat binary file that can be memory mapped and binary searched,
+so a lookup needs no database round trip:
+
+    header  magic b"SHUTSNAP", format version u32, snapshot version u64, watermark f64, count u64
+    records count x (key u64, mask u16), little endian, sorted by key
+
+Bit c of the mask is category c, bit 15 means the llm answered unknown (-1). Channels that are not
+categorized yet are not in the snapshot. Every build writes the next snapshot version next to the
+previous ones and points CURRENT at it, a build only reads the channels categorized since the
+previous snapshot's watermark from MongoDB and merges them into the previous records. The watermark
+is the newest categorized_at the build read, taken from the data rather than the builder's clock.
+
+Usage:
+    python category_snapshot.py build              # build the next snapshot from MongoDB
+    python category_snapshot.py lookup HANDLE NAME # categories of one channel in the current snapshot
+"""
+import os
+import sys
+import json
+import struct
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"SHUTSNAP"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIQdQ")
+RECORD_DTYPE = np.dtype([("key", "<u8"), ("mask", "<u2")])
+UNKNOWN_BIT = 15
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR", "./data/snapshots"))
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", 3))     # versions kept on disk, readers may still map older ones
+WATERMARK_SLACK = 60                                   # seconds, writes stamped just before a build may land after it
+
+
+def channel_key(channel_handle, channel_name):
+    """64 bit key of a channel, same handle|name pair the backend looks channels up by"""
+    digest = hashlib.sha256(f"{channel_handle}|{channel_name}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def categories_to_mask(categories):
+    mask = 0
+    for category in categories or []:
+        mask |= 1 << (UNKNOWN_BIT if category < 0 else category)
+    return mask
+
+
+def mask_to_categories(mask):
+    if mask & (1 << UNKNOWN_BIT):
+        return [-1]
+    return [bit for bit in range(UNKNOWN_BIT) if mask & (1 << bit)]
+
+
+class CategorySnapshot:
+    """Read only view of a snapshot file, the records are memory mapped"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            magic, format_version, self.version, self.watermark, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"{self.path} is not a version {FORMAT_VERSION} category snapshot")
+
+        if count:
+            self.records = np.memmap(self.path, dtype=RECORD_DTYPE, mode="r", offset=HEADER.size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self.keys = self.records["key"]
+
+    @classmethod
+    def open(cls, directory=SNAPSHOT_DIR):
+        """Current snapshot of a snapshot directory, None if nothing was built yet"""
+        current = Path(directory) / "CURRENT"
+        if not current.exists():
+            return None
+        return cls(Path(directory) / current.read_text().strip())
+
+    def __len__(self):
+        return len(self.records)
+
+    def lookup(self, channel_handle, channel_name):
+        """Categories of a channel, None if it isn't categorized (yet)"""
+        key = channel_key(channel_handle, channel_name)
+        index = int(np.searchsorted(self.keys, key))
+        if index < len(self.keys) and self.keys[index] == key:
+            return mask_to_categories(int(self.records["mask"][index]))
+        return None
+
+    def lookup_many(self, pairs):
+        """lookup for a list of (channel_handle, channel_name), one vectorized binary search"""
+        if not len(self.keys):
+            return [None] * len(pairs)
+        keys = np.fromiter((channel_key(handle, name) for handle, name in pairs), dtype="<u8", count=len(pairs))
+        indexes = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[indexes] == keys
+        masks = self.records["mask"][indexes]
+        return [mask_to_categories(int(mask)) if hit else None for hit, mask in zip(found, masks)]
+
+
+def _records(docs):
+    records = np.array(
+        [(channel_key(doc["channel_handle"], doc["channel_name"]), categories_to_mask(doc.get("channel_categories"))) for doc in docs],
+        dtype=RECORD_DTYPE,
+    )
+    # a key seen twice in one read keeps its last record
+    _, last = np.unique(records["key"][::-1], return_index=True)
+    return records[::-1][last]
+
+
+def merge(previous, changes):
+    """Previous records with the changed ones replaced or added, sorted by key"""
+    if previous is None or not len(previous):
+        return changes
+    kept = previous[~np.isin(previous["key"], changes["key"])]
+    merged = np.concatenate([np.asarray(kept), changes])
+    return merged[np.argsort(merged["key"], kind="stable")]
+
+
+def write_snapshot(directory, version, watermark, records):
+    """Write snapshot version atomically and make it CURRENT, returns its path"""
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"categories-{version:08d}.bin"
+    tmp_path = directory / f"{path.name}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, version, watermark, len(records)))
+        f.write(np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes())
+    os.replace(tmp_path, path)
+
+    current_tmp = directory / "CURRENT.tmp"
+    current_tmp.write_text(path.name)
+    os.replace(current_tmp, directory / "CURRENT")
+    return path
+
+
+def prune(directory, keep=SNAPSHOT_KEEP):
+    for old in sorted(directory.glob("categories-*.bin"))[:-keep]:
+        old.unlink(missing_ok=True)
+
+
+def build(collection, directory=SNAPSHOT_DIR):
+    """
+    Build the next snapshot from the previous one plus the channels categorized since its watermark
+    (all status 2 channels for the first one). Returns (snapshot, changed channel count), no new
+    version is written when nothing changed.
+    """
+    directory = Path(directory)
+    previous = CategorySnapshot.open(directory)
+
+    query = {"status": 2}
+    if previous is not None:
+        query["categorized_at"] = {"$gte": previous.watermark - WATERMARK_SLACK}
+    docs = list(collection.find(query, {"channel_handle": 1, "channel_name": 1, "channel_categories": 1, "categorized_at": 1}))
+    changes = _records(docs)
+
+    # newest stamp actually read, a write stamped earlier but landing later is still within the slack
+    watermark = max((doc["categorized_at"] for doc in docs if doc.get("categorized_at") is not None), default=None)
+    if watermark is None:
+        watermark = previous.watermark if previous is not None else 0.0
+
+    if previous is not None and len(previous) and len(changes):
+        # the watermark slack reads some channels again, only records that differ are changes
+        indexes = np.minimum(np.searchsorted(previous.keys, changes["key"]), len(previous) - 1)
+        unchanged = (previous.keys[indexes] == changes["key"]) & (previous.records["mask"][indexes] == changes["mask"])
+        changes = changes[~unchanged]
+
+    if previous is not None and not len(changes):
+        return previous, 0
+
+    records = merge(previous.records if previous is not None else None, changes)
+    version = previous.version + 1 if previous is not None else 1
+    path = write_snapshot(directory, version, watermark, records)
+    prune(directory)
+    return CategorySnapshot(path), len(changes)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ("build", "lookup"):
+        print(__doc__)
+        return 1
+
+    if argv[1] == "lookup":
+        snapshot = CategorySnapshot.open()
+        if snapshot is None or len(argv) != 4:
+            print(__doc__ if snapshot is not None else f"No snapshot in {SNAPSHOT_DIR}")
+            return 1
+        print(json.dumps({"version": snapshot.version, "channel_categories": snapshot.lookup(argv[2], argv[3])}))
+        return 0
+
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    client = MongoClient(os.getenv("MONGODB"))
+    try:
+        snapshot, changed = build(client[os.getenv("DB_NAME")]["channels"])
+    finally:
+        client.close()
+    print(f"Snapshot version {snapshot.version}: {len(snapshot)} channels, {changed} changed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,250 @@
+"""
+Local fast-path channel classifier.
+
+Hashed bag of words over channel name, description and video titles fed into one-vs-rest logistic
+regression (numpy only). Trained on channels the LLM already categorized (status 2), used by
+run_script.py to categorize confident channels directly instead of sending them to the groq batch.
+
+Usage:
+    python fast_classifier.py train      # train on status 2 channels and save the model
+    python fast_classifier.py evaluate   # hold-out agreement with the LLM labels
+"""
+import os
+import re
+import sys
+import json
+from pathlib import Path
+
+import numpy as np
+
+NUM_CATEGORIES = 8          # categories 0-7 of the categorizer prompt
+NUM_FEATURES = 2 ** 16      # hashed vocabulary size
+MAX_LABELS = 3              # same cap as the llm response schema
+MODEL_PATH = Path(os.getenv("FAST_CLASSIFIER_MODEL", "./data/fast_classifier.npz"))
+CONFIDENCE_THRESHOLD = float(os.getenv("FAST_CLASSIFIER_THRESHOLD", 0.9))
+
+_WORD_RE = re.compile(r"\w\w+")
+
+
+def channel_text(channel_name, channel_desc, videos):
+    """Text the classifier looks at, same for training docs and freshly fetched channels"""
+    titles = " ".join(video.get("title", "") for video in videos or [])
+    return f"{channel_name or ''} {channel_desc or ''} {titles}"
+
+
+def _hash(token):
+    # FNV-1a, python's hash() is salted per process so it can't be used for a saved model
+    h = 2166136261
+    for byte in token.encode("utf-8"):
+        h = ((h ^ byte) * 16777619) & 0xFFFFFFFF
+    return h % NUM_FEATURES
+
+
+class HashedFeatures:
+    """
+    Sparse row matrix (csr layout in plain numpy arrays), a dense matrix of 2^16 hashed features
+    would need hundreds of KB per channel.
+    """
+
+    def __init__(self, indptr, indices, data):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.row_of = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def dot(self, W):
+        """self @ W"""
+        return np.add.reduceat(W[self.indices] * self.data[:, None], self.indptr[:-1], axis=0)
+
+    def tdot(self, G):
+        """self.T @ G"""
+        out = np.zeros((NUM_FEATURES, G.shape[1]), dtype=np.float32)
+        np.add.at(out, self.indices, self.data[:, None] * G[self.row_of])
+        return out
+
+    def rows(self, selected):
+        indptr = [0]
+        indices, data = [], []
+        for row in selected:
+            start, end = self.indptr[row], self.indptr[row + 1]
+            indices.append(self.indices[start:end])
+            data.append(self.data[start:end])
+            indptr.append(indptr[-1] + end - start)
+        return HashedFeatures(np.array(indptr), np.concatenate(indices), np.concatenate(data))
+
+
+def featurize(texts):
+    """Hashed unigram + bigram counts, log scaled and l2 normalised, one row per text"""
+    indptr = [0]
+    all_indices, all_data = [], []
+    for text in texts:
+        words = _WORD_RE.findall(text.lower())
+        tokens = words + [f"{a} {b}" for a, b in zip(words, words[1:])] + ["__all__"]   # __all__ keeps rows non empty
+        indices, counts = np.unique(np.fromiter((_hash(token) for token in tokens), dtype=np.int64), return_counts=True)
+
+        values = np.log1p(counts).astype(np.float32)
+        values /= np.linalg.norm(values)
+
+        all_indices.append(indices)
+        all_data.append(values)
+        indptr.append(indptr[-1] + len(indices))
+
+    return HashedFeatures(np.array(indptr), np.concatenate(all_indices), np.concatenate(all_data))
+
+
+def labels_to_matrix(label_lists):
+    Y = np.zeros((len(label_lists), NUM_CATEGORIES), dtype=np.float32)
+    for row, labels in enumerate(label_lists):
+        for label in labels:
+            if 0 <= label < NUM_CATEGORIES:
+                Y[row, label] = 1.0
+    return Y
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+
+class FastClassifier:
+    """One-vs-rest logistic regression over hashed features"""
+
+    def __init__(self, weights=None, bias=None, threshold=CONFIDENCE_THRESHOLD):
+        self.weights = weights if weights is not None else np.zeros((NUM_FEATURES, NUM_CATEGORIES), dtype=np.float32)
+        self.bias = bias if bias is not None else np.zeros(NUM_CATEGORIES, dtype=np.float32)
+        self.threshold = threshold
+
+    def fit(self, X, Y, epochs=200, lr=2.0, l2=1e-4):
+        """Full batch gradient descent, feature matrix is small enough for a nightly run"""
+        n = max(len(X), 1)
+        for _ in range(epochs):
+            P = _sigmoid(X.dot(self.weights) + self.bias)
+            grad = P - Y
+            self.weights -= lr * (X.tdot(grad) / n + l2 * self.weights)
+            self.bias -= lr * grad.mean(axis=0)
+        return self
+
+    def predict_proba(self, X):
+        return _sigmoid(X.dot(self.weights) + self.bias)
+
+    def predict(self, X):
+        """
+        Returns list of (categories, confidence) per row. Categories are the ones with p >= 0.5
+        (best first, at most 3), confidence is how sure the least certain yes/no decision is.
+        """
+        P = self.predict_proba(X)
+        results = []
+        for p in P:
+            order = np.argsort(-p)
+            categories = [int(c) for c in order[:MAX_LABELS] if p[c] >= 0.5] or [int(order[0])]
+            confidence = float(np.min(np.maximum(p, 1 - p)))
+            results.append((categories, confidence))
+        return results
+
+    def classify(self, channel_name, channel_desc, videos):
+        """Categories for one channel if the model is confident enough, otherwise None"""
+        categories, confidence = self.predict(featurize([channel_text(channel_name, channel_desc, videos)]))[0]
+        return categories if confidence >= self.threshold else None
+
+    def save(self, path=MODEL_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, weights=self.weights, bias=self.bias)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH, threshold=CONFIDENCE_THRESHOLD):
+        """Load a saved model, None if there is no trained model yet"""
+        if not Path(path).exists():
+            return None
+        data = np.load(path)
+        return cls(data["weights"], data["bias"], threshold)
+
+
+def load_training_data(collection):
+    """
+    Texts and llm labels of every channel the llm categorized. Channels this classifier labelled
+    itself are left out, retraining on them would feed the model its own output.
+    """
+    texts, labels = [], []
+    cursor = collection.aggregate([
+        {"$match": {"status": 2, "channel_categories": {"$ne": [-1]}, "categorized_by": {"$ne": "fast_classifier"}}},
+        {"$project": {"channel_name": 1, "channel_description": 1, "channel_categories": 1}},
+        # videos live in their own collection, see migrate_videos in run_script.py
+        {"$lookup": {"from": "channel_videos", "localField": "_id", "foreignField": "_id", "as": "stored"}},
+        {"$project": {"channel_name": 1, "channel_description": 1, "channel_categories": 1, "videos": {"$first": "$stored.videos"}}},
+    ])
+    for doc in cursor:
+        texts.append(channel_text(doc.get("channel_name"), doc.get("channel_description"), doc.get("videos")))
+        labels.append(doc["channel_categories"])
+    return texts, labels
+
+
+def evaluate(model, X, label_lists):
+    """Agreement of the model with the llm labels, overall and on the confident (fast path) subset"""
+    predictions = model.predict(X)
+    confident = [i for i, (_, confidence) in enumerate(predictions) if confidence >= model.threshold]
+
+    def exact(indexes):
+        if not indexes:
+            return 0.0
+        return sum(set(predictions[i][0]) == set(label_lists[i]) for i in indexes) / len(indexes)
+
+    def overlap(indexes):
+        if not indexes:
+            return 0.0
+        return sum(bool(set(predictions[i][0]) & set(label_lists[i])) for i in indexes) / len(indexes)
+
+    return {
+        "samples": len(label_lists),
+        "exact_agreement": exact(range(len(label_lists))),
+        "any_overlap": overlap(range(len(label_lists))),
+        "threshold": model.threshold,
+        "fast_path_coverage": len(confident) / max(len(label_lists), 1),
+        "fast_path_exact_agreement": exact(confident),
+        "fast_path_any_overlap": overlap(confident),
+    }
+
+
+def main(argv):
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    if len(argv) < 2 or argv[1] not in ("train", "evaluate"):
+        print(__doc__)
+        return 1
+
+    client = MongoClient(os.getenv("MONGODB"))
+    try:
+        texts, labels = load_training_data(client[os.getenv("DB_NAME")]["channels"])
+    finally:
+        client.close()
+
+    if not texts:
+        print("No categorized channels to train on")
+        return 1
+
+    X = featurize(texts)
+    Y = labels_to_matrix(labels)
+
+    # Fixed hold-out split so evaluate numbers are comparable between runs
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(texts))
+    split = int(len(order) * 0.8)
+    train_idx, test_idx = order[:split], order[split:]
+
+    model = FastClassifier().fit(X.rows(train_idx), Y[train_idx])
+    report = evaluate(model, X.rows(test_idx), [labels[i] for i in test_idx])
+    print(json.dumps(report, indent=2))
+
+    if argv[1] == "train":
+        # Final model is trained on everything
+        FastClassifier().fit(X, Y).save()
+        print(f"Saved model to {MODEL_PATH}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,188 @@
+"""
+Run metrics and logging setup for the cron job.
+
+Counters and timing histograms are collected in the process wide `metrics` registry while a run
+goes on, at the end of the run they are written as a json report and as a prometheus textfile
+(for node_exporter's textfile collector).
+"""
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# seconds, prometheus style cumulative buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_RESERVED_LOG_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= target:
+                return bound
+        return self.max
+
+
+class Metrics:
+    """Thread safe registry of labelled counters and timing histograms"""
+
+    def __init__(self, prefix="shutup"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started_at = time.time()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = _key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            key = _key(name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def summary(self):
+        with self.lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            timings = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum_s": round(h.sum, 4),
+                    "max_s": round(h.max, 4),
+                    "p50_s": h.quantile(0.5),
+                    "p99_s": h.quantile(0.99),
+                }
+                for (name, labels), h in sorted(self.histograms.items())
+            ]
+        return {
+            "started_at": self.started_at,
+            "duration_s": round(time.time() - self.started_at, 3),
+            "counters": counters,
+            "timings": timings,
+        }
+
+    def prometheus(self):
+        """Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f"{self.prefix}_{name}_total{_format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                metric = f"{self.prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                for (histogram, labels), h in sorted(self.histograms.items()):
+                    if histogram != name:
+                        continue
+                    for bound, count in zip(h.buckets, h.counts):
+                        lines.append(f"{metric}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {h.count}")
+                    lines.append(f"{metric}_sum{_format_labels(labels)} {h.sum}")
+                    lines.append(f"{metric}_count{_format_labels(labels)} {h.count}")
+
+        lines.append(f"# TYPE {self.prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{self.prefix}_last_run_timestamp_seconds {self.started_at}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path, prometheus_path):
+        """Write the json report and prometheus textfile, atomically so a collector never reads half a file"""
+        for path, content in ((json_path, json.dumps(self.summary(), indent=2)), (prometheus_path, self.prometheus())):
+            if not path:
+                continue
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+
+metrics = Metrics()
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line, extra= fields of the log call become top level keys"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_LOG_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging(level=None, fmt=None):
+    """LOG_LEVEL (default INFO, DEBUG enables per record output) and LOG_FORMAT (json or text)"""
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    fmt = fmt or os.getenv("LOG_FORMAT", "json")
+
+    handler = logging.StreamHandler()
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # client libraries are chatty at INFO
+    for noisy in ("httpx", "googleapiclient", "urllib3"):
+        logging.getLogger(noisy).setLevel(max(logging.WARNING, root.level))
@@ -1,36 +1,435 @@
+import time
+_import_started = time.perf_counter()
+
 import os
-import boto3
 import urllib.request
-from pymongo import MongoClient, UpdateOne
-from googleapiclient.discovery import build
-from groq import Groq
+import urllib.parse
+import sqlite3
 import json
-from pydantic import BaseModel, Field, field_validator
+import re
+from functools import lru_cache
 from typing import List
 from datetime import datetime
+from zoneinfo import ZoneInfo
 import uuid
 from dotenv import load_dotenv
 load_dotenv()
 from pathlib import Path
 import threading
+import queue
+import zlib
+import gzip
+import shutil
+import argparse
+import logging
+from metrics import metrics, setup_logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 
+log = logging.getLogger("run_script")
 
 MONGO_URL = os.getenv("MONGODB")
 DB_NAME = os.getenv("DB_NAME")
 YT_API_KEY = os.getenv("YOUTUBE_API_KEY")
 GQ_API_KEY = os.getenv("GROQ_API")
 
+class Lazy:
+    """
+    Proxy that builds the wrapped client on first use, so a run only pays for the clients (and the
+    heavy imports behind them) it actually touches, e.g. update_running_jobs never builds youtube.
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.instance = None
+        self.init_seconds = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    started = time.perf_counter()
+                    self.instance = self.factory()
+                    self.init_seconds = time.perf_counter() - started
+        return self.instance
+
+    @property
+    def initialized(self):
+        return self.instance is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+def _make_groq_client():
+    from groq import Groq
+    return Groq(api_key=GQ_API_KEY)
+
+def _make_youtube():
+    # discovery document bundled with google-api-python-client, no network round trip to fetch it
+    from googleapiclient.discovery import build
+    return build('youtube', 'v3', developerKey=YT_API_KEY, static_discovery=True, cache_discovery=False)
+
+def _make_mongo_client():
+    from pymongo import MongoClient
+    return MongoClient(MONGO_URL)
+
 # Initialize Groq client
-groq_client = Groq(api_key=GQ_API_KEY)
+groq_client = Lazy("groq", _make_groq_client)
 
-youtube = build('youtube', 'v3', developerKey=YT_API_KEY)
+youtube = Lazy("youtube", _make_youtube)
 
 # Pick a folder where you want the file
 folder = Path("./data")   # creates ./data if not exists
 folder.mkdir(parents=True, exist_ok=True)
 
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]
+client = Lazy("mongo", _make_mongo_client)
+db = Lazy("db", lambda: client[DB_NAME])
+
+YT_MAX_IDS_PER_CALL = 50  # channels().list accepts at most 50 comma separated id's
+
+# YouTube quota settings, channels().list and playlistItems().list both cost 1 unit per call
+YT_WORKERS = int(os.getenv("YT_WORKERS", 8))
+YT_QUOTA_PER_SECOND = float(os.getenv("YT_QUOTA_PER_SECOND", 10))
+YT_DAILY_QUOTA = int(os.getenv("YT_DAILY_QUOTA", 10000))
+YT_QUOTA_SHARED = os.getenv("YT_QUOTA_SHARED", "1") != "0"             # daily budget shared by every process through MongoDB
+YT_QUOTA_RESERVE_UNITS = int(os.getenv("YT_QUOTA_RESERVE_UNITS", 50))  # units taken from the shared budget at a time
+YT_MAX_RETRIES = 5
+
+# Number of uploads sampled per channel, channels with at least YT_LARGE_CHANNEL_VIDEOS uploads get the deeper sample
+YT_PLAYLIST_DEPTH = int(os.getenv("YT_PLAYLIST_DEPTH", 50))
+YT_PLAYLIST_DEPTH_LARGE = int(os.getenv("YT_PLAYLIST_DEPTH_LARGE", 100))
+YT_LARGE_CHANNEL_VIDEOS = int(os.getenv("YT_LARGE_CHANNEL_VIDEOS", 500))
+
+
+def quota_day():
+    """YouTube daily quota resets at midnight pacific time"""
+    return datetime.now(ZoneInfo("America/Los_Angeles")).date()
+
+
+class QuotaExhausted(Exception):
+    """Raised once the daily quota budget is used up or youtube reports quotaExceeded"""
+
+
+class QuotaLedger:
+    """
+    Daily quota units spent by every process sharing the api key (cron runs, --claim/--shard workers,
+    daemons), one doc per quota day in MongoDB. Units are reserved in blocks so the ledger is written
+    once per block instead of once per call, unspent units are handed back with release().
+    """
+
+    def __init__(self, collection_name, block):
+        self.collection_name = collection_name
+        self.block = block
+
+    def reserve(self, day, units, budget):
+        """Take a block (or at least units) from the day's budget, returns the units granted, 0 once it is used up"""
+        from pymongo.errors import DuplicateKeyError
+
+        collection = db[self.collection_name]
+        try:
+            collection.update_one({"_id": day.isoformat()}, {"$setOnInsert": {"used": 0}}, upsert=True)
+        except DuplicateKeyError:
+            pass    # another process created the day's doc at the same time
+
+        for wanted in dict.fromkeys((max(self.block, units), units)):
+            result = collection.update_one({"_id": day.isoformat(), "used": {"$lte": budget - wanted}}, {"$inc": {"used": wanted}})
+            if result.modified_count:
+                return wanted
+        return 0
+
+    def release(self, day, units):
+        db[self.collection_name].update_one({"_id": day.isoformat()}, {"$inc": {"used": -units}})
+
+    def exhaust(self, day, budget):
+        """youtube says the quota is gone, make every process stop for the day"""
+        db[self.collection_name].update_one({"_id": day.isoformat()}, {"$max": {"used": budget}}, upsert=True)
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket sized in youtube quota units (also used for the groq request/token
+    per minute limits, with an unlimited daily budget). Refills at rate units/second
+    up to capacity and also enforces a hard daily budget, once the budget is spent every
+    acquire raises QuotaExhausted so the fetch stage can stop cleanly. The budget starts
+    over when the youtube quota day (pacific time) rolls over, for long running processes.
+    With a ledger the daily budget is shared with every other process using it, otherwise it only
+    counts this process' calls.
+    Rate limit responses halve the refill rate (once per backoff_window, however many workers
+    hit the same burst), successful calls after that step it back up to the configured rate.
+    """
+
+    def __init__(self, rate, capacity, daily_budget, backoff_window=5.0, ledger=None):
+        self.rate = rate
+        self.max_rate = rate
+        self.backoff_window = backoff_window
+        self.last_backoff = float("-inf")
+        self.capacity = capacity
+        self.daily_budget = daily_budget
+        self.tokens = capacity
+        self.used = 0
+        self.ledger = ledger
+        self.reserved = 0   # units granted by the ledger, not spent yet
+        self.exhausted = False
+        self.day = quota_day()
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _roll_day(self):
+        today = quota_day()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+            self.reserved = 0
+            self.exhausted = False
+
+    def _within_budget(self, units):
+        if self.ledger is None:
+            return self.used + units <= self.daily_budget
+        if self.reserved < units:
+            try:
+                self.reserved += self.ledger.reserve(self.day, units, self.daily_budget)
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: TokenBucket.acquire function while reserving shared quota, counting locally -> %s", e)
+                return self.used + units <= self.daily_budget
+        return self.reserved >= units
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, units=1):
+        while True:
+            with self.lock:
+                self._roll_day()
+                if self.exhausted or not self._within_budget(units):
+                    self.exhausted = True
+                    raise QuotaExhausted(f"daily quota budget of {self.daily_budget} units used up")
+
+                self._refill()
+                units = min(units, self.capacity)   # a request bigger than the bucket would wait forever
+                if self.tokens >= units:
+                    self.tokens -= units
+                    self.used += units
+                    self.reserved = max(self.reserved - units, 0)
+                    return
+                wait = (units - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        """Adaptive back off after a 429/rateLimitExceeded, halve the refill rate"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_backoff < self.backoff_window:
+                return
+            self.last_backoff = now
+            self.rate = max(self.rate / 2, 0.1)
+            self.tokens = 0
+
+    def speed_up(self):
+        """After a successful call, additive increase back towards the configured rate"""
+        with self.lock:
+            if self.rate < self.max_rate and time.monotonic() - self.last_backoff >= self.backoff_window:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def is_exhausted(self):
+        """exhausted, but starts over once the quota day rolled over"""
+        with self.lock:
+            self._roll_day()
+            return self.exhausted
+
+    def mark_exhausted(self):
+        with self.lock:
+            self.exhausted = True
+            self.reserved = 0
+            if self.ledger is not None:
+                try:
+                    self.ledger.exhaust(self.day, self.daily_budget)
+                except Exception as e:
+                    log.error("ERR OCCURRED IN:: TokenBucket.mark_exhausted function while updating shared quota -> %s", e)
+
+    def release(self):
+        """Hand the reserved but unspent units back to the ledger, at the end of a run"""
+        with self.lock:
+            if self.ledger is None or not self.reserved:
+                return
+            try:
+                self.ledger.release(self.day, self.reserved)
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: TokenBucket.release function while releasing shared quota -> %s", e)
+            self.reserved = 0
+
+
+yt_quota = TokenBucket(
+    YT_QUOTA_PER_SECOND, YT_QUOTA_PER_SECOND, YT_DAILY_QUOTA,
+    ledger=QuotaLedger("yt_quota", YT_QUOTA_RESERVE_UNITS) if YT_QUOTA_SHARED else None
+)
+
+# Local youtube response cache settings
+YT_CACHE_ENABLED = os.getenv("YT_CACHE", "1") != "0"
+YT_CACHE_FRESH_SECONDS = int(os.getenv("YT_CACHE_FRESH_SECONDS", 24 * 60 * 60))   # served without any api call
+YT_CACHE_TTL_SECONDS = int(os.getenv("YT_CACHE_TTL_SECONDS", 30 * 24 * 60 * 60))  # evicted after this
+YT_CACHE_MAX_BYTES = int(os.getenv("YT_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+
+
+class YTCache:
+    """
+    On disk (sqlite) cache of youtube api responses keyed by request parameters.
+    Fresh entries are served locally, stale ones are revalidated with If-None-Match so an
+    unchanged resource comes back as 304 without a payload. Entries older than the ttl and
+    the oldest entries above the size cap are evicted by evict().
+    """
+
+    def __init__(self, path, fresh_seconds, ttl_seconds, max_bytes):
+        self.path = path
+        self.fresh_seconds = fresh_seconds
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        """sqlite connection, opened on first use (not at import), callers hold self.lock"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, etag TEXT, body TEXT NOT NULL, fetched_at REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_fetched_at ON responses (fetched_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key_for(request):
+        """Request uri without the api key, params sorted so equal requests share an entry"""
+        parsed = urllib.parse.urlsplit(request.uri)
+        params = sorted((k, v) for k, v in urllib.parse.parse_qsl(parsed.query) if k != "key")
+        return f"{parsed.path}?{urllib.parse.urlencode(params)}"
+
+    def get(self, key):
+        """Returns (etag, body, age in seconds) or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT etag, body, fetched_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        age = time.time() - row[2]
+        if age > self.ttl_seconds:
+            return None
+        return row[0], json.loads(row[1]), age
+
+    def put(self, key, response):
+        body = json.dumps(response, ensure_ascii=False)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, etag, body, fetched_at, size) VALUES (?, ?, ?, ?, ?)",
+                (key, response.get("etag"), body, time.time(), len(body))
+            )
+            self.conn.commit()
+
+    def touch(self, key):
+        """Resource was revalidated (304), restart its freshness window"""
+        with self.lock:
+            self.conn.execute("UPDATE responses SET fetched_at = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+
+    def evict(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE fetched_at < ?", (time.time() - self.ttl_seconds,))
+
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                removed = 0
+                for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY fetched_at").fetchall():
+                    if total - removed <= self.max_bytes:
+                        break
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    removed += size
+
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+yt_cache = YTCache(folder / "yt_cache.sqlite3", YT_CACHE_FRESH_SECONDS, YT_CACHE_TTL_SECONDS, YT_CACHE_MAX_BYTES) if YT_CACHE_ENABLED else None
+
+# httplib2 is not thread safe so every fetch worker gets its own connection
+_yt_http = threading.local()
+
+def yt_execute(request, units=1):
+    """
+    Execute a youtube api request under the shared quota limiter with retries on rate limiting.
+    Responses go through the local cache, fresh hits don't touch the network at all.
+    """
+    from googleapiclient.errors import HttpError
+    import httplib2
+
+    if not hasattr(_yt_http, "http"):
+        _yt_http.http = httplib2.Http(timeout=30)
+    endpoint = urllib.parse.urlsplit(request.uri).path.rsplit("/", 1)[-1]
+
+    cache_key = cached = None
+    if yt_cache is not None:
+        cache_key = YTCache.key_for(request)
+        cached = yt_cache.get(cache_key)
+        if cached is not None:
+            etag, body, age = cached
+            if age <= yt_cache.fresh_seconds:
+                metrics.inc("youtube_calls", endpoint=endpoint, result="cache_hit")
+                return body
+            if etag:
+                request.headers["If-None-Match"] = etag
+
+    for attempt in range(YT_MAX_RETRIES):
+        yt_quota.acquire(units)
+        metrics.inc("youtube_quota_units", units, endpoint=endpoint)
+        started = time.perf_counter()
+        try:
+            response = request.execute(http=_yt_http.http)
+            metrics.observe("youtube_call", time.perf_counter() - started, endpoint=endpoint)
+            metrics.inc("youtube_calls", endpoint=endpoint, result="ok")
+            yt_quota.speed_up()
+            if yt_cache is not None:
+                yt_cache.put(cache_key, response)
+            return response
+        except HttpError as e:
+            metrics.observe("youtube_call", time.perf_counter() - started, endpoint=endpoint)
+            if e.resp.status == 304 and cached is not None:
+                metrics.inc("youtube_calls", endpoint=endpoint, result="not_modified")
+                yt_cache.touch(cache_key)
+                return cached[1]
+
+            reason = ""
+            try:
+                reason = json.loads(e.content)["error"]["errors"][0]["reason"]
+            except Exception:
+                pass
+
+            metrics.inc("youtube_calls", endpoint=endpoint, result=reason or str(e.resp.status))
+            if e.resp.status == 403 and reason in ("quotaExceeded", "dailyLimitExceeded"):
+                yt_quota.mark_exhausted()
+                raise QuotaExhausted(f"youtube reported {reason}")
+            if e.resp.status == 429 or reason in ("rateLimitExceeded", "userRateLimitExceeded"):
+                yt_quota.slow_down()
+                time.sleep(2 ** attempt)
+                continue
+            raise
+
+    raise Exception(f"youtube request still rate limited after {YT_MAX_RETRIES} retries")
 
 # TODO: Update this function to get more context about the channel, call youtube api with additional param to get channel tittle description etc
 def get_yt_playlist_id(identifier, search_by='id'):
@@ -57,7 +456,7 @@ def get_yt_playlist_id(identifier, search_by='id'):
                 id=clean_id
             )
 
-        response = request.execute()
+        response = yt_execute(request)
 
         # if response['items']:
         #     uploads_playlist_id = response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
@@ -67,431 +466,1720 @@ def get_yt_playlist_id(identifier, search_by='id'):
         if not response['items']:
             return None
 
-        channel = response['items'][0]
-        snippet = channel['snippet']
-        stats = channel['statistics']
-
-        info = {
-            'channel_id': channel['id'],
-            'title': snippet.get('title'),
-            'description': snippet.get('description'),
-            'published_at': snippet.get('publishedAt'),
-            'country': snippet.get('country'),
-            'thumbnails': snippet.get('thumbnails', {}),
-            'view_count': stats.get('viewCount'),
-            'subscriber_count': stats.get('subscriberCount'),
-            'video_count': stats.get('videoCount'),
-            'uploads_playlist_id': channel['contentDetails']['relatedPlaylists']['uploads']
-        }
-
-        return info
+        return parse_channel_info(response['items'][0])
+    except QuotaExhausted:
+        raise
     except Exception as e:
-        print("ERR OCCURRED IN:: get_yt_playlist_id function while fetching channel data -> ", e)
+        log.error("ERR OCCURRED IN:: get_yt_playlist_id function while fetching channel data -> %s", e)
         return  None
 
-def get_videos_from_playlist(playlist_id):
-    """Get 10 videos from a specific playlist"""
+def parse_channel_info(channel):
+    """Flatten a channels().list item into the channel info dict used by the job"""
+    snippet = channel['snippet']
+    stats = channel['statistics']
+
+    return {
+        'channel_id': channel['id'],
+        'title': snippet.get('title'),
+        'description': snippet.get('description'),
+        'published_at': snippet.get('publishedAt'),
+        'country': snippet.get('country'),
+        'thumbnails': snippet.get('thumbnails', {}),
+        'view_count': stats.get('viewCount'),
+        'subscriber_count': stats.get('subscriberCount'),
+        'video_count': stats.get('videoCount'),
+        'uploads_playlist_id': channel['contentDetails']['relatedPlaylists']['uploads']
+    }
+
+def is_handle(channel_handle):
+    """Handles will have @ in the first two chars, channel id's wont"""
+    return "@" in channel_handle[:2]
+
+def get_yt_channels_bulk(channel_handles, executor=None):
+    """
+    Resolve many channels with as few channels().list calls as possible.
+    Channel id's are grouped into one request per 50 id's (api limit), handles can't be
+    batched so they are looked up one by one. Returns dict keyed by the original handle,
+    value is the channel info dict or None if channel was not found (or quota ran out).
+    When an executor is passed the lookups run on its worker pool.
+    """
+    handles = []
+    ids = {}    # clean id -> original channel_handle values
+
+    for channel_handle in channel_handles:
+        if is_handle(channel_handle):
+            handles.append(channel_handle)
+        else:
+            ids.setdefault(channel_handle.replace('/', ''), []).append(channel_handle)
+
+    id_list = list(ids)
+    chunks = [id_list[start:start + YT_MAX_IDS_PER_CALL] for start in range(0, len(id_list), YT_MAX_IDS_PER_CALL)]
+
+    def lookup_handle(channel_handle):
+        try:
+            return {channel_handle: get_yt_playlist_id(channel_handle, search_by='handle')}
+        except QuotaExhausted:
+            return {channel_handle: None}
+
+    def lookup_chunk(chunk):
+        found = {}
+        try:
+            response = yt_execute(youtube.channels().list(
+                part='snippet,statistics,contentDetails,brandingSettings',
+                id=",".join(chunk),
+                maxResults=YT_MAX_IDS_PER_CALL
+            ))
+            items = response.get('items', [])
+        except QuotaExhausted:
+            items = []
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: get_yt_channels_bulk function while fetching channel data -> %s", e)
+            items = []
+
+        for item in items:
+            try:
+                found[item['id']] = parse_channel_info(item)
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: get_yt_channels_bulk function while parsing channel %s -> %s", item.get('id'), e)
+
+        return {
+            channel_handle: found.get(clean_id)
+            for clean_id in chunk
+            for channel_handle in ids[clean_id]
+        }
+
+    mapper = executor.map if executor else map
+    results = {}
+    for partial in mapper(lookup_chunk, chunks):
+        results.update(partial)
+    for partial in mapper(lookup_handle, handles):
+        results.update(partial)
+
+    return results
+
+def fetch_channels(batch):
+    """
+    Fetch stage of execute_new_jobs. Resolves channel info and uploaded videos for a batch of
+    channel docs on a bounded worker pool sharing the youtube quota limiter.
+    Returns list of (channel, channel_info, new_videos, sample_videos) for channels that have videos,
+    new_videos being only the uploads newer than what is already stored for the channel.
+    Channels skipped because the quota ran out are left out so they stay at status 0 for the next run.
+    """
+    def fetch_videos(channel):
+        channel_info = channel_infos.get(channel["channel_handle"])
+
+        # If there is no channel info (may occur due to invalid channel name or handle)
+        if channel_info is None:
+            return None
+
+        depth = playlist_depth(channel_info)
+        newest = newest_stored_video(channel)
+
+        try:
+            new_videos = get_videos_from_playlist(
+                channel_info['uploads_playlist_id'],
+                max_videos=depth,
+                last_video_id=newest["video_id"] if newest else None,
+                last_published_at=newest["published_at"] if newest else None
+            )
+        except QuotaExhausted:
+            return None
+
+        # Categorizer sample is the new uploads topped up with the newest stored ones
+        sample_videos = (new_videos + stored_videos.get(channel["_id"], []))[:depth]
+
+        # If there are not videos to process or err occurred in get_videos_from_playlist function
+        if len(sample_videos) == 0:
+            return None
+
+        return channel, channel_info, new_videos, sample_videos
+
+    with ThreadPoolExecutor(max_workers=YT_WORKERS) as executor:
+        channel_infos = get_yt_channels_bulk([channel["channel_handle"] for channel in batch], executor)
+        stored_videos = load_stored_videos([channel["_id"] for channel in batch if channel.get("latest_video")])
+        fetched = [result for result in executor.map(fetch_videos, batch) if result is not None]
+
+    return fetched
+
+def get_videos_from_playlist(playlist_id, max_videos=YT_PLAYLIST_DEPTH, last_video_id=None, last_published_at=None):
+    """
+    Get up to max_videos newest videos from a specific playlist, following nextPageToken as needed.
+    In incremental mode (last_video_id / last_published_at of the newest stored video) it stops as
+    soon as it reaches a video that is already stored, so only the delta is returned.
+    """
+    videos = []
+    page_token = None
+
     try:
-        request = youtube.playlistItems().list(
-            part='snippet',
-            playlistId=playlist_id,
-            maxResults=50
-        )
-        response = request.execute()
+        while len(videos) < max_videos:
+            request = youtube.playlistItems().list(
+                part='snippet',
+                playlistId=playlist_id,
+                maxResults=min(50, max_videos - len(videos)),
+                pageToken=page_token
+            )
+            response = yt_execute(request)
+
+            for item in response.get('items', []):
+                video_data = {
+                    'video_id': item['snippet']['resourceId']['videoId'],
+                    'title': item['snippet']['title'],
+                    'description': item['snippet']['description'] if item['snippet']['description'] else '',
+                    'published_at': item['snippet']['publishedAt'],
+                    'thumbnail': item['snippet']['thumbnails'].get('medium', {}).get('url'),
+                    'channel_title': item['snippet']['channelTitle']
+                }
 
-        videos = []
-        for item in response.get('items', []):
-            video_data = {
-                'video_id': item['snippet']['resourceId']['videoId'],
-                'title': item['snippet']['title'],
-                'description': item['snippet']['description'] if item['snippet']['description'] else '',
-                'published_at': item['snippet']['publishedAt'],
-                'thumbnail': item['snippet']['thumbnails']['medium']['url'],
-                'channel_title': item['snippet']['channelTitle']
-            }
-            videos.append(video_data)
+                # uploads playlist is newest first, everything from here on is already stored
+                if video_data['video_id'] == last_video_id or (last_published_at and video_data['published_at'] <= last_published_at):
+                    return videos
+
+                videos.append(video_data)
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
 
+        return videos[:max_videos]
+
+    except QuotaExhausted:
+        raise
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: get_videos_from_playlist function while fetching playlist information %s: %s", playlist_id, e)
         return videos
 
+def playlist_depth(channel_info):
+    """How many uploads to sample for a channel, large channels get a deeper sample for the categorizer"""
+    try:
+        video_count = int(channel_info.get('video_count') or 0)
+    except ValueError:
+        video_count = 0
+
+    return YT_PLAYLIST_DEPTH_LARGE if video_count >= YT_LARGE_CHANNEL_VIDEOS else YT_PLAYLIST_DEPTH
+
+def newest_stored_video(channel):
+    """Newest video already stored for the channel (kept on the channel doc as latest_video), None if nothing stored yet"""
+    return channel.get("latest_video")
+
+def load_stored_videos(channel_ids):
+    """Stored videos (newest first) of many channels in one query, dict keyed by channel _id"""
+    if not channel_ids:
+        return {}
+    try:
+        return {doc["_id"]: doc.get("videos", []) for doc in db["channel_videos"].find({"_id": {"$in": channel_ids}})}
     except Exception as e:
-        print(f"ERR OCCURRED IN:: get_videos_from_playlist function while fetching playlist information {playlist_id}: {e}")
-        return []
+        log.error("ERR OCCURRED IN:: load_stored_videos function while reading stored videos -> %s", e)
+        return {}
 
-def write_to_batch_file(channel_name, channel_desc, uploaded_videos, file_path, unique_id) :
-    # Manual schema with proper additionalProperties
-    response_schema = {
-        "type": "object",
-        "properties": {
-            "channel_name": {
-                "type": "string"
-            },
-            "categories": {
-                "type": "array",
-                "items": {
-                    "type": "integer",
-                    "minimum": 0,
-                    "maximum": 9
-                },
-                "minItems": 1,
-                "maxItems": 3,
-                "uniqueItems": True
-            }
+# Groq batch api accepts up to 50k requests / 200MB per input file, keep some headroom on the size
+GROQ_BATCH_MAX_REQUESTS = int(os.getenv("GROQ_BATCH_MAX_REQUESTS", 50000))
+GROQ_BATCH_MAX_BYTES = int(os.getenv("GROQ_BATCH_MAX_BYTES", 190 * 1024 * 1024))
+# A file is also sealed and submitted during the run once it holds this many requests or is this old,
+# so a long run uploads as it goes instead of everything at the end
+GROQ_BATCH_SEAL_REQUESTS = int(os.getenv("GROQ_BATCH_SEAL_REQUESTS", 5000))
+GROQ_BATCH_SEAL_SECONDS = int(os.getenv("GROQ_BATCH_SEAL_SECONDS", 10 * 60))
+
+
+class BatchFileWriter:
+    """
+    Packs batch requests into jsonl files up to the groq per file limits. Keeps one buffered handle
+    open and tracks the running request count and byte size, a file is sealed when the next request
+    would not fit, once it reaches seal_requests requests or seal_seconds of age (or on close).
+    Sealed files are returned as (file_path, channels) tuples, channels only carry what the status
+    write needs (see write_to_batch_file).
+    """
+
+    def __init__(self, folder, max_requests=GROQ_BATCH_MAX_REQUESTS, max_bytes=GROQ_BATCH_MAX_BYTES,
+                 seal_requests=GROQ_BATCH_SEAL_REQUESTS, seal_seconds=GROQ_BATCH_SEAL_SECONDS):
+        self.folder = folder
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.seal_requests = min(seal_requests, max_requests)
+        self.seal_seconds = seal_seconds
+        self.file = None
+        self.file_path = None
+        self.opened_at = None
+        self.channels = []
+        self.size = 0
+
+    def _open(self):
+        self.file_path = self.folder / f"{uuid.uuid4()}.jsonl"
+        self.file = open(self.file_path, "xb", buffering=1024 * 1024)
+        self.opened_at = time.monotonic()
+        self.channels = []
+        self.size = 0
+
+    def write(self, batch_request, channel):
+        """Append one request, returns list of files sealed to make room for it"""
+        line = (json.dumps(batch_request, ensure_ascii=False) + "\n").encode("utf-8")
+        sealed = []
+
+        if self.file is not None and (len(self.channels) + 1 > self.max_requests or self.size + len(line) > self.max_bytes):
+            sealed.append(self.seal())
+        if self.file is None:
+            self._open()
+
+        self.file.write(line)
+        self.size += len(line)
+        self.channels.append(channel)
+
+        if len(self.channels) >= self.seal_requests or time.monotonic() - self.opened_at >= self.seal_seconds:
+            sealed.append(self.seal())
+        return sealed
+
+    def seal(self):
+        """Close the current file, returns (file_path, channels) or None if nothing was written"""
+        if self.file is None:
+            return None
+
+        self.file.close()
+        metrics.inc("batch_files")
+        metrics.inc("batch_file_bytes", self.size)
+        metrics.inc("batch_file_requests", len(self.channels))
+        sealed = (self.file_path, self.channels)
+        log.debug(f"Sealed batch file {self.file_path} with {len(self.channels)} requests ({self.size} bytes)")
+        self.file = None
+        self.file_path = None
+        self.opened_at = None
+        self.channels = []
+        self.size = 0
+        return sealed
+
+
+# Local artifact store settings
+ARTIFACTS_RETENTION_DAYS = int(os.getenv("ARTIFACTS_RETENTION_DAYS", 30))
+ARTIFACTS_MAX_BYTES = int(os.getenv("ARTIFACTS_MAX_BYTES", 5 * 1024 * 1024 * 1024))
+
+
+def open_artifact(path):
+    """Text handle on a stored batch file, gzip compressed or plain (files from before the store)"""
+    if str(path).endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+class ArtifactStore:
+    """
+    Batch input and result files, gzip compressed on disk and indexed by batch_id / file_id in a
+    local (sqlite) manifest. Results are kept until ingested, so a crash between download and ingest
+    is recovered with replay instead of the (one time) groq download. evict() drops files older than
+    the retention and the oldest files above the size cap.
+    """
+
+    def __init__(self, path, retention_seconds, max_bytes):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        """sqlite connection, opened on first use (not at import), callers hold self.lock"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts ("
+                "path TEXT PRIMARY KEY, kind TEXT NOT NULL, batch_id TEXT, file_id TEXT, "
+                "created_at REAL NOT NULL, size INTEGER NOT NULL, raw_size INTEGER NOT NULL, ingested_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS artifacts_batch_id ON artifacts (batch_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS artifacts_file_id ON artifacts (file_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS artifacts_created_at ON artifacts (created_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def add(self, path, kind, batch_id=None, file_id=None):
+        """
+        Compress a plain file into the store (the original is removed), returns the stored path.
+        Never fails: if compressing fails (e.g. disk full) the plain file is kept and indexed instead,
+        if even the manifest can't be written the plain file is still there for --replay <path>.
+        """
+        path = Path(path)
+        stored = path.with_name(path.name + ".gz")
+        raw_size = path.stat().st_size
+        try:
+            with open(path, "rb") as src, gzip.open(stored, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            size = stored.stat().st_size
+            path.unlink()
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: ArtifactStore.add function while compressing %s, keeping it uncompressed -> %s", path, e)
+            stored.unlink(missing_ok=True)
+            stored, size = path, raw_size
+
+        try:
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO artifacts (path, kind, batch_id, file_id, created_at, size, raw_size) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (str(stored), kind, batch_id, file_id, time.time(), size, raw_size)
+                )
+                self.conn.commit()
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: ArtifactStore.add function while indexing %s -> %s", stored, e)
+        metrics.inc("artifact_bytes", size, kind=kind)
+        metrics.inc("artifact_raw_bytes", raw_size, kind=kind)
+        return stored
+
+    def link(self, path, batch_id, file_id):
+        """Point a stored input file at the batch it was (re)submitted as"""
+        with self.lock:
+            self.conn.execute("UPDATE artifacts SET batch_id = ?, file_id = ? WHERE path = ?", (batch_id, file_id, str(path)))
+            self.conn.commit()
+
+    def find(self, kind=None, batch_id=None, file_id=None, ingested=None):
+        """Stored paths matching all given fields, newest first"""
+        query, params = [], []
+        for column, value in (("kind", kind), ("batch_id", batch_id), ("file_id", file_id)):
+            if value is not None:
+                query.append(f"{column} = ?")
+                params.append(value)
+        if ingested is not None:
+            query.append("ingested_at IS NOT NULL" if ingested else "ingested_at IS NULL")
+        where = f"WHERE {' AND '.join(query)}" if query else ""
+        with self.lock:
+            rows = self.conn.execute(f"SELECT path FROM artifacts {where} ORDER BY created_at DESC", params).fetchall()
+        return [Path(row[0]) for row in rows if Path(row[0]).exists()]
+
+    def mark_ingested(self, path):
+        with self.lock:
+            self.conn.execute("UPDATE artifacts SET ingested_at = ? WHERE path = ?", (time.time(), str(path)))
+            self.conn.commit()
+
+    def evict(self):
+        """Retention and size cap, results that were never ingested are kept"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, size, created_at FROM artifacts "
+                "WHERE NOT (kind != 'input' AND ingested_at IS NULL) ORDER BY created_at"
+            ).fetchall()
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+
+            expired_before = time.time() - self.retention_seconds
+            evicted = 0
+            for path, size, created_at in rows:
+                if created_at >= expired_before and total <= self.max_bytes:
+                    break
+                Path(path).unlink(missing_ok=True)
+                self.conn.execute("DELETE FROM artifacts WHERE path = ?", (path,))
+                total -= size
+                evicted += 1
+
+            self.conn.commit()
+        if evicted:
+            metrics.inc("artifacts_evicted", evicted)
+            log.debug(f"Evicted {evicted} stored batch files")
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+artifacts = ArtifactStore(folder / "artifacts.sqlite3", ARTIFACTS_RETENTION_DAYS * 24 * 60 * 60, ARTIFACTS_MAX_BYTES)
+
+
+# Structured output schema for the categorizer, manual schema with proper additionalProperties
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "channel_name": {
+            "type": "string"
         },
-        "required": ["channel_name", "categories"],
-        "additionalProperties": False
-    }
+        "categories": {
+            "type": "array",
+            "items": {
+                "type": "integer",
+                "minimum": 0,
+                "maximum": 9
+            },
+            "minItems": 1,
+            "maxItems": 3,
+            "uniqueItems": True
+        }
+    },
+    "required": ["channel_name", "categories"],
+    "additionalProperties": False
+}
+
+
+@lru_cache(maxsize=None)
+def result_model():
+    """Pydantic model the llm results are validated with, built once on first use (keeps pydantic off the startup path)"""
+    from pydantic import BaseModel, Field, field_validator
+
+    # can be used to validate results
+    class ChannelCategoryAnalysis(BaseModel):
+        channel_name: str = Field(description="The name of the YouTube channel")
+        categories: List[int] = Field(
+            min_length=1,
+            max_length=3,
+            description="Array of category integers (0-9)"
+        )
+
+        @field_validator('categories')
+        @classmethod
+        def validate_categories(cls, v):
+            for cat in v:
+                if not (0 <= cat <= 9):
+                    raise ValueError(f'Category {cat} must be between 0 and 9')
+            if len(v) != len(set(v)):
+                raise ValueError('Categories must be unique')
+            return v
+
+    return ChannelCategoryAnalysis
 
-    system_prompt = """You are a YouTube channel categorizer. Analyze the channel name and video content to determine which categories the channel belongs to.
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", 1000))  # updates per bulk_write while ingesting results
 
-    Categories (use integers 0-6):
-    0: IT & Computer Science (AI, CS, IT, Data Science, Cybersecurity, Game development etc)
-    1: Core Engineering & Robotics (Mechanical, Electrical, Mechatronics, Robotics, Aeronautics, Chemical, Electronics & Communication, Instrumentation, Industrial & Production, Aerospace, Automobile, Metallurgical & Materials, Environmental, Mining,Marine & Ocean, Petroleum ,Biomedical, Nuclear, Structural , Agricultural, Textile etc)
-    2: Medicine, Health & Life Sciences	(Medicine, Biotech, Biomedical, Nursing, Biotechnology, Genetics, Zoology, Botany, Biochemistry, Environmental Science, Pharmacy,  Marine Biology, Medical Laboratory Technology,Bachelor of Medicine, Bachelor of Surgery, Bachelor of Ayurvedic Medicine & Surger, Bachelor of Homeopathic Medicine & Surgery, Bachelor of Physiotherapy, Biological Sciences   etc)
-    3: Business, Finance & Economics	(MBA, Fintech, Management, Finance, Chartered Accountant, Economics, Commerce, Foreign Trade Management, Banking, Marketing,  Supply Chain Management  etc)
-    4: Arts & Humanities  (Literature, Philosophy, Geography, Economics, Political Science, Humanities, History, Languages & Linguistics,Religious Studies, Sociology, Psychology, Anthropology, Archaeology, Arts & Fine Arts, Music & Performing Arts, Theater & Drama, Design & Visual Communication , Media & Communication, Cultural Studies, Education & Pedagogy, Public Administration & Policy, Interdisciplinary Arts, Fashion & Textile Design, Game Design & Animation , Digital Media Arts, Creative Writing & Literature, Cultural Heritage and Preservation, Environmental and Ecological Arts, Heritage & Museum Studies  etc)
-    5: Competitive Exams (Gaokao, IIT JEE Advanced, UPSC Civil Services Exam (CSE), GRE, CFA (Chartered Financial Analyst), USMLE (United States Medical Licensing Exam), CA Exam (ICAI, ICMAI), Mensa IQ Test, CAT (Common Admission Test), CLAT (Common Law Admission Test), LSAT, NEET (National Eligibility cum Entrance Test), AIIMS MBBS Entrance, SSC CGL (Combined Graduate Level), IBPS PO, SBI PO, GATE (Graduate Aptitude Test in Engineering), TOEFL / IELTS, Defence Exams (NDA, CDS, AFCAT), ESA (Engineering Services Examination), National Talent Search Exam, International Science Olympiads  etc)
-    6: High School/ Pre-university (English, Hindi, Maths, Science, Social Science, Economics, Geography, History etc)
-    7: Others
+SYSTEM_PROMPT = """You are a YouTube channel categorizer. Analyze the channel name and video content to determine which categories the channel belongs to.
 
-    Choose relevant categories based on the video content."""
+Categories (use integers 0-6):
+0: IT & Computer Science (AI, CS, IT, Data Science, Cybersecurity, Game development etc)
+1: Core Engineering & Robotics (Mechanical, Electrical, Mechatronics, Robotics, Aeronautics, Chemical, Electronics & Communication, Instrumentation, Industrial & Production, Aerospace, Automobile, Metallurgical & Materials, Environmental, Mining,Marine & Ocean, Petroleum ,Biomedical, Nuclear, Structural , Agricultural, Textile etc)
+2: Medicine, Health & Life Sciences	(Medicine, Biotech, Biomedical, Nursing, Biotechnology, Genetics, Zoology, Botany, Biochemistry, Environmental Science, Pharmacy,  Marine Biology, Medical Laboratory Technology,Bachelor of Medicine, Bachelor of Surgery, Bachelor of Ayurvedic Medicine & Surger, Bachelor of Homeopathic Medicine & Surgery, Bachelor of Physiotherapy, Biological Sciences   etc)
+3: Business, Finance & Economics	(MBA, Fintech, Management, Finance, Chartered Accountant, Economics, Commerce, Foreign Trade Management, Banking, Marketing,  Supply Chain Management  etc)
+4: Arts & Humanities  (Literature, Philosophy, Geography, Economics, Political Science, Humanities, History, Languages & Linguistics,Religious Studies, Sociology, Psychology, Anthropology, Archaeology, Arts & Fine Arts, Music & Performing Arts, Theater & Drama, Design & Visual Communication , Media & Communication, Cultural Studies, Education & Pedagogy, Public Administration & Policy, Interdisciplinary Arts, Fashion & Textile Design, Game Design & Animation , Digital Media Arts, Creative Writing & Literature, Cultural Heritage and Preservation, Environmental and Ecological Arts, Heritage & Museum Studies  etc)
+5: Competitive Exams (Gaokao, IIT JEE Advanced, UPSC Civil Services Exam (CSE), GRE, CFA (Chartered Financial Analyst), USMLE (United States Medical Licensing Exam), CA Exam (ICAI, ICMAI), Mensa IQ Test, CAT (Common Admission Test), CLAT (Common Law Admission Test), LSAT, NEET (National Eligibility cum Entrance Test), AIIMS MBBS Entrance, SSC CGL (Combined Graduate Level), IBPS PO, SBI PO, GATE (Graduate Aptitude Test in Engineering), TOEFL / IELTS, Defence Exams (NDA, CDS, AFCAT), ESA (Engineering Services Examination), National Talent Search Exam, International Science Olympiads  etc)
+6: High School/ Pre-university (English, Hindi, Maths, Science, Social Science, Economics, Geography, History etc)
+7: Others
 
-    # print(f"Channel name: {channel_name}\nChannel description: {channel_desc} \nVideos:\n{uploaded_videos}")
+Choose relevant categories based on the video content."""
 
-    batch_request = {
-        "custom_id": str(uuid.uuid4()),  # Unique ID
+# Per channel token budgets for the user prompt (estimated locally, see estimate_tokens)
+PROMPT_TITLES_TOKEN_BUDGET = int(os.getenv("PROMPT_TITLES_TOKEN_BUDGET", 1200))
+PROMPT_DESCRIPTION_TOKEN_BUDGET = int(os.getenv("PROMPT_DESCRIPTION_TOKEN_BUDGET", 250))
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_TITLE_NOISE_RE = re.compile(r"[\W\d_]+")
+
+def estimate_tokens(text):
+    """
+    Rough local token count, no tokenizer download or network. BPE vocabularies split words into
+    pieces of ~4 chars so every word costs ceil(len/4) tokens and every symbol one token.
+    """
+    if not text:
+        return 0
+    return sum(-(-len(piece) // 4) for piece in _TOKEN_RE.findall(text))
+
+def trim_to_tokens(text, budget):
+    """Cut text on a word boundary so it fits in budget tokens"""
+    if not text or estimate_tokens(text) <= budget:
+        return text or ""
+
+    used = 0
+    for match in _TOKEN_RE.finditer(text):
+        used += -(-len(match.group()) // 4)
+        if used > budget:
+            return text[:match.start()].rstrip() + " ..."
+    return text
+
+def select_titles(titles, budget):
+    """
+    Pick the most informative titles that fit in budget tokens. Near identical titles (same words
+    once numbers/punctuation are dropped, e.g. "Lecture 1", "Lecture 2") are kept once, then titles
+    are greedily chosen by how many new words they add per token. Output keeps the original order.
+    """
+    candidates = []
+    seen = set()
+    for index, title in enumerate(titles):
+        key = _TITLE_NOISE_RE.sub(" ", title.lower()).strip()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        candidates.append((index, title, set(key.split()), estimate_tokens(title) + 6))    # +6 for the "n. video title: " prefix
+
+    chosen = []
+    covered = set()
+    used = 0
+    while candidates:
+        best = max(candidates, key=lambda c: (len(c[2] - covered) / c[3], -c[0]))
+        candidates.remove(best)
+        if used + best[3] > budget:
+            continue
+        chosen.append(best)
+        covered |= best[2]
+        used += best[3]
+
+    return [title for _, title, _, _ in sorted(chosen)]
+
+def build_user_prompt(channel_name, channel_desc, videos):
+    """Build the user message for a channel within the token budgets, returns (prompt, estimated input tokens)"""
+    titles = select_titles([video['title'] for video in videos if video.get('title')], PROMPT_TITLES_TOKEN_BUDGET)
+    uploaded_videos = "\n".join(f"{i}. video title: {title}" for i, title in enumerate(titles, 1))
+    channel_desc = trim_to_tokens(channel_desc, PROMPT_DESCRIPTION_TOKEN_BUDGET)
+
+    prompt = f"Channel name: {channel_name}\nChannel description: {channel_desc} \nVideos:\n{uploaded_videos}"
+    return prompt, estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(prompt)
+
+def build_batch_request(channel_name, channel_desc, videos, channel):
+    """
+    Build the chat completion batch request for a channel, the estimated input tokens of the request are
+    recorded on the channel as estimated_input_tokens.
+    custom_id is the channel _id, so the mapping from result to channel travels with the request itself.
+    """
+    user_prompt, estimated_tokens = build_user_prompt(channel_name, channel_desc, videos)
+    channel["estimated_input_tokens"] = estimated_tokens
+
+    return {
+        "custom_id": str(channel["_id"]),  # maps the result back to the channel doc
         "method": "POST",
         "url": "/v1/chat/completions",
         "body": {
             "model": "meta-llama/llama-4-maverick-17b-128e-instruct",
             "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Channel name: {channel_name}\nChannel description: {channel_desc} \nVideos:\n{uploaded_videos}"}
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
             ],
             "response_format": {
                 "type": "json_schema",
                 "json_schema": {
                     "name": "channel_category_analysis",
-                    "schema": response_schema
+                    "schema": RESPONSE_SCHEMA
                 }
             },
             "temperature": 0
         }
     }
 
+def write_to_batch_file(batch_request, batch_writer, channel):
+    """
+    Add a request to the batch writer, returns sealed files. Only the channel's _id and estimated
+    input tokens are kept until the file is submitted, everything else is already stored.
+    """
     try:
-        with open(file_path, "a", encoding="utf-8") as file:
-            file.write(json.dumps(batch_request, ensure_ascii=False) + "\n")
-        
-        print(f"Added batch request for channel: {channel_name}")
-    except (FileNotFoundError, json.JSONDecodeError):
-       print("ERR OCCURRED IN:: write_to_batch_file function -> File dose not exist/incorrect json -> ", e)
+        sealed = batch_writer.write(batch_request, {"_id": channel["_id"], "estimated_input_tokens": channel["estimated_input_tokens"]})
+        log.debug("Added batch request for channel: %s (~%s input tokens)", channel["channel_name"], channel["estimated_input_tokens"])
+        return sealed
     except Exception as e:
-        print("ERR OCCURRED IN:: write_to_batch_file function -> ", e)    
+        log.error("ERR OCCURRED IN:: write_to_batch_file function -> %s", e)
+        return []
 
 def submit_task(file_path):
     """upload batch file to groq and submit the file id return both groq file_path and batch_id"""
 
     try:
-        file_upload_response  = groq_client.files.create(file=open(file_path, "rb"), purpose="batch")
+        with metrics.timer("groq_upload"):
+            if str(file_path).endswith(".gz"):
+                # input from the artifact store (resubmission), groq wants the plain jsonl
+                with gzip.open(file_path, "rb") as file:
+                    upload = (Path(file_path).stem, file.read())
+                file_upload_response = groq_client.files.create(file=upload, purpose="batch")
+            else:
+                with open(file_path, "rb") as file:
+                    file_upload_response = groq_client.files.create(file=file, purpose="batch")
     except Exception as e:
-        print("ERR OCCURRED IN:: submit_task function while uploading batch file to groq cloud-> ", e)
+        log.error("ERR OCCURRED IN:: submit_task function while uploading batch file to groq cloud-> %s", e)
         return None, None
 
-    print("Uploaded file disc:: ", file_upload_response)
+    log.debug("Uploaded file disc:: %s", file_upload_response)
   
     try:
-        submit_run_response = groq_client.batches.create(
-            completion_window="24h",
-            endpoint="/v1/chat/completions",
-            input_file_id=file_upload_response.id,
-        )
+        with metrics.timer("groq_batch_create"):
+            submit_run_response = groq_client.batches.create(
+                completion_window="24h",
+                endpoint="/v1/chat/completions",
+                input_file_id=file_upload_response.id,
+            )
 
         return file_upload_response.id, submit_run_response.id
     except Exception as e:
-        print("ERR OCCURRED IN:: submit_task function while calling chat completion api using batch file -> ", e)
+        log.error("ERR OCCURRED IN:: submit_task function while calling chat completion api using batch file -> %s", e)
         return None, None
 
-def execute_new_jobs():
+# Synchronous chat completions for small backlogs, same request bodies as the batch files
+GROQ_MODE = os.getenv("GROQ_MODE", "auto")                             # auto, sync or batch
+SYNC_MAX_BACKLOG = int(os.getenv("SYNC_MAX_BACKLOG", 100))             # auto mode uses batches above this many pending channels
+GROQ_SYNC_CONCURRENCY = int(os.getenv("GROQ_SYNC_CONCURRENCY", 8))
+GROQ_SYNC_RPM = int(os.getenv("GROQ_SYNC_RPM", 30))                    # requests per minute of the groq plan
+GROQ_SYNC_TPM = int(os.getenv("GROQ_SYNC_TPM", 6000))                  # tokens per minute of the groq plan
+GROQ_SYNC_MAX_RETRIES = 5
+
+groq_requests = TokenBucket(GROQ_SYNC_RPM / 60, GROQ_SYNC_RPM, float("inf"))
+groq_tokens = TokenBucket(GROQ_SYNC_TPM / 60, GROQ_SYNC_TPM, float("inf"))
+
+
+class SyncRequestWriter:
+    """
+    Same write/seal interface as BatchFileWriter, but keeps the requests in memory and seals them
+    in chunks of max_requests for submit_sync, sealed chunks are (requests, channels) tuples.
+    """
+
+    def __init__(self, max_requests):
+        self.max_requests = max_requests
+        self.requests = []
+        self.channels = []
+
+    def write(self, batch_request, channel):
+        self.requests.append(batch_request)
+        self.channels.append(channel)
+        if len(self.requests) >= self.max_requests:
+            return [self.seal()]
+        return []
+
+    def seal(self):
+        if not self.requests:
+            return None
+        sealed = (self.requests, self.channels)
+        self.requests = []
+        self.channels = []
+        return sealed
+
+
+def choose_groq_mode(collection):
+    """sync or batch for this run, auto picks sync only while the pending backlog is small"""
+    if GROQ_MODE in ("sync", "batch"):
+        return GROQ_MODE
+    backlog = collection.count_documents({"status": 0}, limit=SYNC_MAX_BACKLOG + 1)
+    return "sync" if backlog <= SYNC_MAX_BACKLOG else "batch"
+
+def complete_sync(batch_request, estimated_tokens):
+    """
+    One chat completion under the request/token per minute limiters, retried with back off on rate
+    limits and server errors. Returns a result line in the batch output format, None on failure.
     """
-    Fetch fifty channels which have status==0, calls youtube api to get playlist id using handle_name, 
+    for attempt in range(GROQ_SYNC_MAX_RETRIES):
+        groq_requests.acquire()
+        groq_tokens.acquire(estimated_tokens)
+        try:
+            with metrics.timer("groq_sync_completion"):
+                response = groq_client.chat.completions.create(**batch_request["body"])
+            metrics.inc("groq_sync_calls", result="ok")
+            groq_requests.speed_up()
+            return {
+                "custom_id": batch_request["custom_id"],
+                "response": {"status_code": 200, "body": response.model_dump()},
+            }
+        except Exception as e:
+            status_code = getattr(e, "status_code", None)
+            metrics.inc("groq_sync_calls", result=str(status_code or "error"))
+            if status_code == 429 or (status_code or 0) >= 500:
+                if status_code == 429:
+                    groq_requests.slow_down()
+                time.sleep(2 ** attempt)
+                continue
+            log.error("ERR OCCURRED IN:: complete_sync function while calling chat completion api -> %s", e)
+            return None
+
+    log.error("ERR OCCURRED IN:: complete_sync function, still rate limited after %s retries", GROQ_SYNC_MAX_RETRIES)
+    return None
+
+def submit_sync(requests, channels):
+    """
+    Run a chunk of requests as concurrent chat completions and write the results to a local file in
+    the batch output format, so they are ingested by ingest_results_file like batch results.
+    Returns (channels that got a result, results file path or None).
+    """
+    with ThreadPoolExecutor(max_workers=GROQ_SYNC_CONCURRENCY) as executor:
+        results = list(executor.map(
+            complete_sync, requests, [channel["estimated_input_tokens"] for channel in channels]
+        ))
+
+    completed = [channel for channel, result in zip(channels, results) if result is not None]
+    if len(completed) < len(channels):
+        # left at status 0, the next run picks them up again
+        log.warning(f"{len(channels) - len(completed)} of {len(channels)} sync completions failed")
+    if not completed:
+        return [], None
+
+    file_path = folder / f"{uuid.uuid4()}_sync_results.jsonl"
+    with open(file_path, "w", encoding="utf-8") as f:
+        for result in results:
+            if result is not None:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    metrics.inc("groq_sync_channels", len(completed))
+    return completed, artifacts.add(file_path, "sync_results")
+
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 2))  # batches buffered between two stages
+FAST_CLASSIFIER_ENABLED = os.getenv("FAST_CLASSIFIER", "1") != "0"
+_STAGE_DONE = object()
+
+def run_stage(name, work, in_queue, out_queue, stop_event, on_done=None):
+    """
+    Generic pipeline stage: pulls items from in_queue and puts work(item) on out_queue (None results
+    are dropped). An exception in work sets stop_event so the reader stops producing, items already
+    in flight are still drained. Once the input is exhausted on_done is called (for stages that hold
+    state to flush) and the done marker is forwarded.
+    """
+    while True:
+        item = in_queue.get()
+        if item is _STAGE_DONE:
+            break
+
+        try:
+            result = work(item)
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: execute_new_job pipeline in %s stage -> %s", name, e)
+            stop_event.set()
+            continue
+
+        if result is not None and out_queue is not None:
+            out_queue.put(result)
+
+    if on_done is not None:
+        try:
+            on_done()
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: execute_new_job pipeline while finishing %s stage -> %s", name, e)
+            stop_event.set()
+
+    if out_queue is not None:
+        out_queue.put(_STAGE_DONE)
+
+# Channel docs stay small: videos live in channel_videos (one doc per channel, newest CHANNEL_VIDEOS_CAP kept)
+# and the hot channels collection is only read with this projection
+CHANNEL_VIDEOS_CAP = int(os.getenv("CHANNEL_VIDEOS_CAP", 100))
+CHANNEL_PROJECTION = {"channel_name": 1, "channel_handle": 1, "status": 1, "latest_video": 1}
+
+def store_videos_ops(channel_id, videos):
+    """Upsert for a channel's channel_videos doc, keeps only the newest CHANNEL_VIDEOS_CAP videos"""
+    from pymongo import UpdateOne
+
+    return UpdateOne(
+        {"_id": channel_id},
+        {"$push": {"videos": {"$each": videos, "$sort": {"published_at": -1}, "$slice": CHANNEL_VIDEOS_CAP}}},
+        upsert=True
+    )
+
+def migrate_videos(chunk_size=500):
+    """
+    One-off migration: move the embedded videos array of existing channel docs into channel_videos
+    and leave only latest_video behind on the channel doc.
+    """
+    from pymongo import UpdateOne
+
+    collection = db["channels"]
+    moved = 0
+
+    cursor = collection.find({"videos.0": {"$exists": True}}, {"videos": 1})
+    while True:
+        docs = [doc for _, doc in zip(range(chunk_size), cursor)]
+        if not docs:
+            break
+
+        video_ops, channel_ops = [], []
+        for doc in docs:
+            videos = sorted(doc["videos"], key=lambda video: video.get("published_at") or "", reverse=True)
+            newest = videos[0]
+            video_ops.append(store_videos_ops(doc["_id"], videos))
+            channel_ops.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"latest_video": {"video_id": newest.get("video_id"), "published_at": newest.get("published_at")}},
+                 "$unset": {"videos": ""}}
+            ))
+
+        # videos first, so an interrupted migration never drops videos from a channel
+        db["channel_videos"].bulk_write(video_ops, ordered=False)
+        collection.bulk_write(channel_ops, ordered=False)
+        moved += len(docs)
+        log.debug(f"Migrated videos of {moved} channels")
+
+    # docs without videos just lose the empty array
+    result = collection.update_many({"videos": {"$exists": True}}, {"$unset": {"videos": ""}})
+    log.info(f"Migration done, moved videos of {moved} channels, cleaned {result.modified_count} empty arrays")
+
+# Backlog order: queue_rank is the insert time in seconds, the backend pulls it ahead by REQUEST_BOOST_SECONDS
+# every time a user looks the pending channel up. Lowest rank first, so demand jumps the queue and plain
+# waiting (aging) still gets every channel its turn. Channels from before the ranking have no rank and go first.
+QUEUE_ORDER = [("queue_rank", 1)]
+
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", 60 * 60))  # must outlive a fetch plus GROQ_BATCH_SEAL_SECONDS in the batch writer and the upload
+
+def in_shard(channel_id, shard):
+    """shard is (index, count), channels are pinned to a shard by a stable hash of their _id"""
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(str(channel_id).encode()) % count == index
+
+def unleased(now):
+    """Filter for channels no worker holds an unexpired lease on"""
+    return {"$or": [{"lease_until": {"$exists": False}}, {"lease_until": {"$lt": now}}]}
+
+def claim_channels(collection, worker_id, limit, shard=None):
+    """
+    Atomically lease up to limit pending channels for this worker. Candidates are status 0 channels
+    without a lease or with an expired one (worker crashed), update_many only flips those that are
+    still unleased so two workers racing for the same channel can't both win, the claim token then
+    tells us which ones we got. Returns the claimed channel docs.
+    """
+    now = datetime.now().timestamp()
+    claimable = {"status": 0, **unleased(now)}
+
+    # with sharding the hash isn't queryable, the candidates are paged through and filtered here
+    # until the batch is full, other shards' channels at the head of the queue are skipped
+    if shard is None:
+        candidates = collection.find(claimable, {"_id": 1}).sort(QUEUE_ORDER).limit(limit)
+    else:
+        candidates = collection.find(claimable, {"_id": 1}).sort(QUEUE_ORDER).batch_size(limit * shard[1])
+    ids = []
+    for doc in candidates:
+        if in_shard(doc["_id"], shard):
+            ids.append(doc["_id"])
+            if len(ids) == limit:
+                break
+    if not ids:
+        return []
+
+    token = uuid.uuid4().hex
+    collection.update_many(
+        {"_id": {"$in": ids}, **claimable},
+        {"$set": {"lease_owner": worker_id, "lease_token": token, "lease_until": now + LEASE_SECONDS}}
+    )
+    return list(collection.find({"lease_token": token}, CHANNEL_PROJECTION).sort(QUEUE_ORDER))
+
+def release_leases(collection, channel_ids, worker_id):
+    """Give claimed but unprocessed channels back to the backlog right away instead of after LEASE_SECONDS"""
+    try:
+        result = collection.update_many(
+            {"_id": {"$in": channel_ids}, "status": 0, "lease_owner": worker_id},
+            {"$unset": {"lease_owner": "", "lease_token": "", "lease_until": ""}}
+        )
+        metrics.inc("leases_released", result.modified_count)
+        log.info(f"Released the leases of {result.modified_count} unprocessed channels")
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: release_leases function while releasing channel leases -> %s", e)
+
+def execute_new_jobs(claim=False, worker_id=None, shard=None):
+    """
+    Fetch fifty channels which have status==0 (most requested / longest waiting first, see QUEUE_ORDER), calls youtube api to get playlist id using handle_name, 
     then create a batch file for groq cloud llama 4 llm and update the status to 1 if successful.
+    Batch files are packed up to GROQ_BATCH_SEAL_REQUESTS requests / GROQ_BATCH_SEAL_SECONDS of age (within
+    the groq per file limits), so one file usually spans many fetch batches and is submitted during the run.
+    What a channel's fetch produced (new uploads, description, baseline counts) is stored by the writer
+    stage right away, so a crash later in the run doesn't lose the quota spent on it.
+
+    Runs as a pipeline of stages (cursor reader -> youtube fetcher -> batch file writer -> groq submitter
+    -> mongo status writer) connected by bounded queues, so batch N+1 is fetched while batch N is
+    uploading and a slow stage applies backpressure instead of piling batches up in memory.
+
+    With claim=True channels are leased (see claim_channels) instead of read with a plain cursor so
+    several workers can drain the backlog without processing a channel twice, shard=(index, count)
+    additionally pins this worker to one hash partition of the channels. The plain cursor still skips
+    channels other workers hold a lease on, but doesn't lease its own.
+
+    Small backlogs (see choose_groq_mode) skip the batch api, the same requests are sent as concurrent
+    chat completions and the results ingested right away by the status writer.
     """
-    print("Inside execute new jobs")
+    from pymongo import UpdateOne
+
+    log.info("Inside execute new jobs")
 
     batch_collection = db['batches']
     collection = db["channels"]
     BATCH_SIZE = 50  # TODO: Increase batch size to 50
+    worker_id = worker_id or f"{os.uname().nodename}-{os.getpid()}"
 
-    # Use a cursor to stream through results in batches
+    # status index the pending channel reads depend on (lease_until keeps claim_channels cheap), no-op if it exists
     try:
-        cursor = collection.find({"status": 0}).batch_size(BATCH_SIZE)  # Might need its own exceptional handling
+        collection.create_index([("status", 1), ("lease_until", 1)])
+        # small ranking index over the pending backlog only
+        collection.create_index(QUEUE_ORDER, partialFilterExpression={"status": 0})
     except Exception as e:
-        print("ERR OCCURRED IN:: execute_new_job function while acquiring cursor from MongoDB for batch insert")
-        return 
-    
-    while True:
-        batch = []
+        log.error("ERR OCCURRED IN:: execute_new_job function while creating status index -> %s", e)
+
+    cursor = None
+    if not claim:
+        # Use a cursor to stream through results in batches
         try:
-            for _ in range(BATCH_SIZE):
-                record = next(cursor)
-                batch.append(record)
-                print(record)
+            query = {"status": 0, **unleased(datetime.now().timestamp())}
+            cursor = collection.find(query, CHANNEL_PROJECTION).sort(QUEUE_ORDER).batch_size(BATCH_SIZE)  # Might need its own exceptional handling
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: execute_new_job function while acquiring cursor from MongoDB for batch insert")
+            return 
+
+    stop_event = threading.Event()
+    fetch_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    submit_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    status_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stats = {"read": 0, "updated": 0, "fast_path": 0}
+    started_at = time.monotonic()
+
+    def read_batches():
+        try:
+            while not stop_event.is_set():
+                batch = []
+                with metrics.timer("mongo_read"):
+                    if claim:
+                        batch = claim_channels(collection, worker_id, BATCH_SIZE, shard)
+                    else:
+                        try:
+                            for _ in range(BATCH_SIZE):
+                                batch.append(next(cursor))
+                        except StopIteration:
+                            # Fewer remaining docs than batch size - this is handled correctly
+                            pass
+
+                if not batch:
+                    break
+
+                stats["read"] += len(batch)
+                metrics.inc("channels_read", len(batch))
+                fetch_queue.put(batch)
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: execute_new_job function while reading channels from MongoDB -> %s", e)
+        finally:
+            fetch_queue.put(_STAGE_DONE)
 
-        except StopIteration:
-            # Fewer remaining docs than batch size - this is handled correctly
-            pass
+    # claimed channels that were never processed (run stopped early), their leases are released at the end
+    unfinished = []
 
-        if not batch:
-            break
+    def fetch_batch(batch):
+        if stop_event.is_set():
+            unfinished.extend(batch)
+            return None
 
-        # Process this batch
-        print(f"Processing batch of length {len(batch)}")
-        
-        # Add your YouTube API calls and Groq processing here
-        processed_successfully = []
-        unique_id = uuid.uuid4()         
-        file_name = f"{unique_id}.jsonl" 
-        file_path = folder / file_name
-        with open(file_path, "x"):
-            pass   # file is created, nothing written
-        
-        
-        for channel in batch:
-            print(channel["channel_name"], channel["status"])
-            channel_info = {}
-
-            if "@" in channel["channel_handle"][:2]:
-                channel_info = get_yt_playlist_id(channel["channel_handle"], search_by='handle') # handle will have @ 
-            else :
-                channel_info = get_yt_playlist_id(channel["channel_handle"], search_by='id') # id's wont have @ in it
-
-            # If there is no channel info (may occur due to invalid channel name or handle)
-            if channel_info == None:
-                continue
+        log.debug(f"Processing batch of length {len(batch)}")
 
-            playlist_id = channel_info['uploads_playlist_id']
-            ids = [playlist_id]
-            videos = get_videos_from_playlist(ids[0])
+        # Fetch channel info and videos for the whole batch concurrently under the quota limiter
+        with metrics.timer("youtube_fetch_batch"):
+            fetched = fetch_channels(batch)
+        metrics.inc("channels_fetched", len(fetched))
 
-            # If there are not videos to process or err occurred in get_videos_from_playlist function
-            if len(videos) == 0: 
-                continue
+        if yt_quota.exhausted:
+            log.warning("YOUTUBE QUOTA EXHAUSTED, remaining channels will be picked up in the next run")
+            stop_event.set()
+            fetched_ids = {channel["_id"] for channel, _, _, _ in fetched}
+            unfinished.extend(channel for channel in batch if channel["_id"] not in fetched_ids)
+
+        if not fetched:
+            log.warning("No channels fetched in this batch, skipping submit")
+            return None
+        return fetched
+
+    try:
+        groq_mode = choose_groq_mode(collection)
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: execute_new_job function while counting the backlog -> %s", e)
+        groq_mode = "batch"
+    log.info(f"Categorizing with groq {groq_mode} mode")
+
+    # One writer for the whole run, files roll over only when they near the groq batch limits
+    if groq_mode == "sync":
+        batch_writer = SyncRequestWriter(BATCH_SIZE)
+    else:
+        batch_writer = BatchFileWriter(folder)
+
+    # Channels the local model is confident about skip the llm batch (None until a model is trained)
+    classifier = None
+    if FAST_CLASSIFIER_ENABLED:
+        from fast_classifier import FastClassifier
+        classifier = FastClassifier.load()
+
+    def store_fetched(channels):
+        """Fetched details and new uploads of a batch, stored before its requests are written"""
+        # only the uploads we didn't have yet, into the capped per channel videos doc
+        video_operations = [
+            store_videos_ops(channel["_id"], channel["new_videos"])
+            for channel in channels if channel["new_videos"]
+        ]
+
+        channel_operations = []
+        for channel in channels:
+            fields = {
+                "channel_description": channel["channel_description"],
+                # baseline for refresh_categories, what the categories were based on
+                "channel_id": channel["channel_id"],
+                "video_count": channel["video_count"],
+            }
+            if "estimated_input_tokens" in channel:
+                fields["estimated_input_tokens"] = channel["estimated_input_tokens"]
+            if channel["new_videos"]:
+                newest = channel["new_videos"][0]
+                fields["latest_video"] = {"video_id": newest["video_id"], "published_at": newest["published_at"]}
+            channel_operations.append(UpdateOne({"_id": channel["_id"]}, {"$set": fields}))
+
+        # videos first, latest_video must never point past what is stored
+        with metrics.timer("mongo_fetched_write"):
+            if video_operations:
+                db["channel_videos"].bulk_write(video_operations, ordered=False)
+            collection.bulk_write(channel_operations, ordered=False)
+
+    def write_batch(fetched):
+        fast_path, requests = [], []
+        for channel, channel_info, new_videos, sample_videos in fetched:
+            log.debug("Writing channel %s", channel["channel_name"], extra={"channel_id": str(channel["_id"])})
 
             channel_name = channel["channel_name"]
             channel_desc = channel_info["description"]
- 
-            video_lines = [
-                f"{i}. video title: {video['title']}"
-                for i, video in enumerate(videos, 1)
-            ]
-            uploaded_videos =  "\n".join(video_lines)
-            uploaded_videos = uploaded_videos[:6000]    # After removing the description uploaded videos might not cross 6000 length so do the changes accordingly so it dose not give any error
 
-            write_to_batch_file(channel_name, channel_desc, uploaded_videos, file_path, unique_id)
+            channel["new_videos"] = new_videos
+            channel["channel_description"] = channel_desc
+            channel["channel_id"] = channel_info["channel_id"]
+            channel["video_count"] = int(channel_info["video_count"]) if channel_info["video_count"] else None
 
-            # For now, assuming all process successfully:
-            channel["videos"] = videos
-            processed_successfully.append(channel)
+            if classifier is not None:
+                categories = classifier.classify(channel_name, channel_desc, sample_videos)
+                if categories is not None:
+                    fast_path.append({"_id": channel["_id"], "fast_categories": categories})
+                    continue
 
+            requests.append((build_batch_request(channel_name, channel_desc, sample_videos, channel), channel))
+
+        try:
+            store_fetched([channel for channel, _, _, _ in fetched])
+        except Exception:
+            # nothing of this batch was written, its channels stay pending
+            unfinished.extend(channel for channel, _, _, _ in fetched)
+            raise
+
+        for batch_request, channel in requests:
+            for sealed in write_to_batch_file(batch_request, batch_writer, channel):
+                submit_queue.put(sealed)
+
+        if fast_path:
+            stats["fast_path"] += len(fast_path)
+            metrics.inc("channels_fast_path", len(fast_path))
+            status_queue.put((fast_path, None))
+
+        return None
+
+    def seal_last_batch():
+        sealed = batch_writer.seal()
+        if sealed is not None:
+            submit_queue.put(sealed)
+
+    def submit_batch(written):
+        if groq_mode == "sync":
+            completed, results_path = submit_sync(*written)
+            completed_ids = {channel["_id"] for channel in completed}
+            unfinished.extend(channel for channel in written[1] if channel["_id"] not in completed_ids)
+            return completed, results_path
+
+        file_path, processed_successfully = written
         groq_file_path, batch_id = submit_task(file_path) 
 
         if groq_file_path == None or batch_id == None:
-            print("ERR OCCURRED IN:: execute_new_job function while calling submit_task fn, it returned None in groq_file_path or batch_id -> ", e)
-            return
+            unfinished.extend(processed_successfully)
+            raise Exception(f"submit_task returned None in groq_file_path or batch_id for {file_path}")
 
-
-        # push groq_file_path and batch_id into the batch schema
+        # push groq_file_path and batch_id into the batch schema, first thing after the batch exists on groq
         batch_doc = {
             'file_id': groq_file_path,
             'batch_id': batch_id,
+            'input_file': str(file_path),   # kept for resubmission if the batch fails/expires
             'status': 0,
+            'retries': 0,
             'timestamp': datetime.now().timestamp()
         }
 
         try:
-            result = batch_collection.insert_one(batch_doc)
-            print(f"Successfully inserted batch with batch id: {batch_doc['batch_id']} file id {batch_doc['file_id']}")
+            batch_collection.insert_one(batch_doc)
+            log.debug(f"Successfully inserted batch with batch id: {batch_doc['batch_id']} file id {batch_doc['file_id']}")
         except Exception as e:
-            print(f"ERR OCCURRED IN:: execute_new_job function while inserting batch entry in MongoDB -> {e}")
-    
-        # print("===", len(processed_successfully))
-        # Bulk update status to 1 for all successfully processed channels (deserves its own function)
+            log.error("ERR OCCURRED IN:: execute_new_job function while inserting batch entry in MongoDB -> %s", e)
 
-        try:
-            if processed_successfully:
-                update_operations = [
-                    UpdateOne(
-                        {
-                            "channel_name": channel["channel_name"],
-                            "channel_handle": channel["channel_handle"],
-                        },
-                        {
-                            "$set": {"status": 1},
-                            "$push": {"videos": {"$each": channel["videos"]}}   # just update here to insert videos
-                        }
-                    ) 
-                    for channel in processed_successfully
-                ]
-                
-                result = collection.bulk_write(update_operations)
-                print(f"Updated status for {result.modified_count} documents in this batch")
-        except Exception as e:
-            print("ERR OCCURRED IN:: execute_new_job function while inserting processed channel data to MongoDB -> ", e)
+        # uploaded, the local copy is only needed for a resubmission from now on
+        stored_path = artifacts.add(file_path, "input", batch_id=batch_id, file_id=groq_file_path)
+        if stored_path != file_path:
+            try:
+                batch_collection.update_one({"batch_id": batch_id}, {"$set": {"input_file": str(stored_path)}})
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: execute_new_job function while updating the stored input file of batch %s -> %s", batch_id, e)
+
+        return processed_successfully, None
+
+    def status_update(channel):
+        if "fast_categories" in channel:
+            # categorized locally, done without a round trip through the llm
+            fields = {
+                "status": 2, "channel_categories": channel["fast_categories"], "categorized_by": "fast_classifier",
+                "categorized_at": datetime.now().timestamp(),
+            }
+        else:
+            fields = {"status": 1}
+
+        return {
+            "$set": fields,
+            "$unset": {"lease_owner": "", "lease_token": "", "lease_until": ""},
+        }
+
+    def update_statuses(processed):
+        processed_successfully, results_path = processed
+        if not processed_successfully:
             return
-    
 
-    print("All batches processed successfully!")
+        if results_path is not None:
+            ingest_sync_results(processed_successfully, results_path)
+            return
+
+        # Bulk update status to 1 (or 2 for fast path channels) for all successfully processed channels,
+        # their fetched details were already stored by the writer stage
+        update_operations = [
+            UpdateOne({"_id": channel["_id"]}, status_update(channel))
+            for channel in processed_successfully
+        ]
+
+        with metrics.timer("mongo_status_write"):
+            result = collection.bulk_write(update_operations)
+        stats["updated"] += result.modified_count
+        metrics.inc("channels_updated", result.modified_count)
+        log.debug(f"Updated status for {result.modified_count} documents in this batch")
+
+    def ingest_sync_results(channels, results_path):
+        """
+        Sync mode results go straight from status 0 to 2, there is no batch doc to retry from so the
+        channels are never parked at status 1. The ones without a valid result, or all of them if the
+        ingest fails, stay pending and their leases are released for the next run.
+        """
+        ids = [channel["_id"] for channel in channels]
+        if not ingest_results_file(results_path):
+            unfinished.extend(channels)
+            raise Exception(f"ingesting sync results {results_path} failed, its channels stay pending")
+        artifacts.mark_ingested(results_path)
+
+        collection.update_many({"_id": {"$in": ids}}, {"$unset": {"lease_owner": "", "lease_token": "", "lease_until": ""}})
+        updated = collection.count_documents({"_id": {"$in": ids}, "status": 2})
+        stats["updated"] += updated
+        metrics.inc("channels_updated", updated)
+
+    stages = [
+        threading.Thread(target=read_batches, name="reader"),
+        threading.Thread(target=run_stage, name="fetcher", args=("fetch", fetch_batch, fetch_queue, write_queue, stop_event)),
+        threading.Thread(target=run_stage, name="writer", args=("write", write_batch, write_queue, submit_queue, stop_event, seal_last_batch)),
+        threading.Thread(target=run_stage, name="submitter", args=("submit", submit_batch, submit_queue, status_queue, stop_event)),
+        threading.Thread(target=run_stage, name="status", args=("status", update_statuses, status_queue, None, stop_event)),
+    ]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    if claim and unfinished:
+        release_leases(collection, [channel["_id"] for channel in unfinished], worker_id)
+    yt_quota.release()
+
+    if yt_cache is not None:
+        yt_cache.evict()
+    artifacts.evict()
+
+    elapsed = time.monotonic() - started_at
+    log.info(f"Categorized {stats['fast_path']} channels with the local fast path classifier")
+    log.info(f"Read {stats['read']} channels, updated {stats['updated']} in {elapsed:.1f}s ({stats['updated'] / max(elapsed, 1e-9) * 60:.1f} channels/minute)")
+    log.info(f"YouTube quota used in this run: {yt_quota.used}/{yt_quota.daily_budget} units")
+    if stop_event.is_set():
+        log.warning("Stopped early, see errors above")
+    else:
+        log.info("All batches processed successfully!")
     return
 
+# Batch poller settings
+GROQ_POLL_WORKERS = int(os.getenv("GROQ_POLL_WORKERS", 8))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", 3))
+POLL_MIN_INTERVAL = 5 * 60          # seconds
+POLL_MAX_INTERVAL = 6 * 60 * 60
+BATCH_ERRORS_LOGGED = 3             # lines of a batch error file that make it into the log
+
+def next_check_in(response, age):
+    """
+    Seconds until a running batch is worth checking again. With progress reported the remaining
+    time is extrapolated from the completion rate and we check again halfway there, without
+    progress the wait grows with the age of the batch.
+    """
+    counts = response.get("request_counts") or {}
+    total = counts.get("total") or 0
+    done = (counts.get("completed") or 0) + (counts.get("failed") or 0)
+
+    if total and done:
+        remaining = age * (total - done) / done
+        interval = remaining / 2
+    else:
+        interval = age / 4
+
+    return min(max(interval, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+
+def resubmit_batch(doc):
+    """
+    Re-run a failed/expired batch. Reuses the input file still stored on groq, falls back to
+    uploading the saved local input file again. Returns (file_id, batch_id) or (None, None).
+    """
+    try:
+        response = groq_client.batches.create(
+            completion_window="24h",
+            endpoint="/v1/chat/completions",
+            input_file_id=doc["file_id"],
+        )
+        return doc["file_id"], response.id
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: resubmit_batch function while re-creating batch from groq file %s -> %s", doc['file_id'], e)
+
+    input_file = doc.get("input_file")
+    if input_file and Path(input_file).exists():
+        file_id, batch_id = submit_task(input_file)
+        if batch_id is not None:
+            artifacts.link(input_file, batch_id, file_id)
+        return file_id, batch_id
+
+    return None, None
+
+def batch_channel_ids(input_file):
+    """_id's of the channels in a stored batch input file (the custom_id's), None if the file is gone"""
+    from bson import ObjectId
+
+    if not input_file or not Path(input_file).exists():
+        return None
+    with open_artifact(input_file) as f:
+        return [ObjectId(custom_id) for custom_id in (json.loads(line)["custom_id"] for line in f if line.strip()) if ObjectId.is_valid(custom_id)]
+
+def requeue_channels(ids):
+    """Put submitted (status 1) channels back to status 0, so a later run submits them again. Returns the count"""
+    requeued = 0
+    for start in range(0, len(ids), INGEST_CHUNK_SIZE):
+        result = db["channels"].update_many({"_id": {"$in": ids[start:start + INGEST_CHUNK_SIZE]}, "status": 1}, {"$set": {"status": 0}})
+        requeued += result.modified_count
+    metrics.inc("channels_requeued", requeued)
+    return requeued
+
+def requeue_batch_channels(doc):
+    """Put the channels of a batch we gave up on back to status 0. Returns the number of requeued channels"""
+    ids = batch_channel_ids(doc.get("input_file"))
+    if ids is None:
+        log.warning(f"No input file for batch {doc['batch_id']}, its channels can't be requeued")
+        return 0
+    return requeue_channels(ids)
+
+def log_batch_errors(error_file_id, batch_id):
+    """Log the first lines of a batch's error file, why its requests failed"""
+    file_path = folder / f"{batch_id}_batch_errors.jsonl"
+    try:
+        response = groq_client.files.content(error_file_id)
+        response.write_to_file(file_path)
+        with open(file_path, "r", encoding="utf-8") as f:
+            for _, line in zip(range(BATCH_ERRORS_LOGGED), f):
+                log.warning("Failed request in batch %s: %s", batch_id, line.strip()[:500])
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: log_batch_errors function while reading error file %s -> %s", error_file_id, e)
+    finally:
+        file_path.unlink(missing_ok=True)
+
+def check_batch(doc):
+    """Check one running batch and act on its status, returns the update for its batch doc or None"""
+    now = datetime.now().timestamp()
+
+    try:
+        with metrics.timer("groq_batch_retrieve"):
+            response = groq_client.batches.retrieve(doc["batch_id"])
+        response = json.loads(response.to_json())
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: update_running_jobs function while retrieve batch file form groq -> %s", e)
+        metrics.inc("batch_polls", outcome="error")
+        return {"$set": {"next_check_at": now + POLL_MIN_INTERVAL}}
+
+    metrics.inc("batch_polls", outcome=response["status"])
+
+    # if completed call update_channel_database function(batch_id) to get the result and update channel database
+    if response["status"] == "completed" and response.get("output_file_id") != None:
+        log.info(f"COMPLETED BATCH ID: {response['id']}")
+        if response.get("error_file_id"):
+            # some requests failed, their channels are requeued by the ingest
+            log_batch_errors(response["error_file_id"], response["id"])
+        if update_channel_database(response["output_file_id"], response['id'], doc.get("input_file")):
+            return {"$set": {"status": 1}}
+        return {"$set": {"next_check_at": now + POLL_MIN_INTERVAL}}
+
+    if response["status"] == "completed":
+        # every request failed, groq only writes an error file, handled like a failed batch
+        log.warning(f"BATCH ID: {response['id']} completed without results, request counts {response.get('request_counts')}")
+        if response.get("error_file_id"):
+            log_batch_errors(response["error_file_id"], response["id"])
+
+    if response["status"] in ("completed", "failed", "expired", "cancelled"):
+        retries = doc.get("retries", 0)
+        log.warning(f"ERR IN BATCH ID: {response['id']} ({response['status']}), retry {retries + 1}/{BATCH_MAX_RETRIES}")
+
+        if retries >= BATCH_MAX_RETRIES:
+            try:
+                requeued = requeue_batch_channels(doc)
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: check_batch function while requeuing channels of a failed batch -> %s", e)
+                return {"$set": {"next_check_at": now + POLL_MIN_INTERVAL}}
+            log.warning(f"GIVING UP ON BATCH ID: {response['id']} after {retries} retries, requeued {requeued} channels")
+            return {"$set": {"status": 2}}
+
+        file_id, batch_id = resubmit_batch(doc)
+        metrics.inc("batch_resubmits", result="ok" if batch_id else "failed")
+        if batch_id is None:
+            return {"$set": {"next_check_at": now + POLL_MIN_INTERVAL}, "$inc": {"retries": 1}}
+
+        log.info(f"RESUBMITTED BATCH ID: {response['id']} as {batch_id}")
+        return {
+            "$set": {"batch_id": batch_id, "file_id": file_id, "submitted_at": now, "next_check_at": now + POLL_MIN_INTERVAL},
+            "$inc": {"retries": 1}
+        }
+
+    log.debug(f"BATH ID: {response['status']}")
+    age = now - doc.get("submitted_at", doc.get("timestamp", now))
+    return {"$set": {"next_check_at": now + next_check_in(response, age)}}
+
 def update_running_jobs():
     """
-        Fetch from batch one at a time check the status of batch file if failed re-run, if running skip it and if completed download the result from groq cloud and update the status to 2.
-        Calls update channel database function
+        Check running batches and act on their status: completed ones are downloaded and written to the
+        channel database (batch status 1), failed/expired ones (and completed ones where every request
+        failed) are resubmitted from the saved input file up to BATCH_MAX_RETRIES times (then batch
+        status 2 and their channels go back to status 0), running ones get a next_check_at based on
+        age and reported progress so they are not polled again before that.
+        The cursor is streamed and statuses are checked concurrently on a bounded worker pool.
     """
 
+    collection = db["batches"]
+    now = datetime.now().timestamp()
+
     try:
-        collection = db["batches"] 
-        docs = list(collection.find({"status": 0}))  # TODO: It might load too many records at once
+        cursor = collection.find(
+            {"status": 0, "$or": [{"next_check_at": {"$exists": False}}, {"next_check_at": {"$lte": now}}]},
+            {"batch_id": 1, "file_id": 1, "input_file": 1, "retries": 1, "timestamp": 1, "submitted_at": 1}
+        )
     except Exception as e:
-        print("ERR OCCURRED IN:: update_running_jobs function while fetching all the unprocessed batches -> ", e)
+        log.error("ERR OCCURRED IN:: update_running_jobs function while fetching all the unprocessed batches -> %s", e)
         return
 
-    for doc in docs:
-        # check if batch is finished running , if not continue
+    def poll(doc):
+        update = check_batch(doc)
+        if update is None:
+            return 0
 
         try:
-            response = groq_client.batches.retrieve(doc["batch_id"])
-            response = json.loads(response.to_json())
-            # print(response)
+            result = collection.update_one({'_id': doc["_id"]}, update)
         except Exception as e:
-            print("ERR OCCURRED IN:: update_running_jobs function while retrieve batch file form groq -> ", e)
-            continue
+            log.error("ERR OCCURRED IN:: update_running_jobs function while updating batch status -> %s", e)
+            return 0
+
+        return result.matched_count if update["$set"].get("status") == 1 else 0
+
+    completed = 0
+    with ThreadPoolExecutor(max_workers=GROQ_POLL_WORKERS) as executor:
+        # bounded number of in flight checks so the cursor is consumed as workers free up
+        pending = set()
+        for doc in cursor:
+            pending.add(executor.submit(poll, doc))
+            if len(pending) >= GROQ_POLL_WORKERS * 2:
+                done = next(as_completed(pending))
+                pending.remove(done)
+                completed += done.result()
+        for future in as_completed(pending):
+            completed += future.result()
+
+    log.info("Number of batch completed: %s", completed)
+    artifacts.evict()
+
+def update_channel_database(output_file_id, unique_id, input_file=None):
+    """
+        Takes file path as an input and updates the channel database with the new data.
+        Channels of the batch's input file without a valid result go back to status 0.
+        Returns True if the results were written, False if the batch should be checked again.
+    """
 
-        # if yes call update_channel_database function(batch_id) to get the result and update channel database
-        if response["status"] == "completed" and response["output_file_id"] != None:
-            print(f"COMPLETED BATCH ID: {response['id']}")
-            update_channel_database(response["output_file_id"], response['id'])
-        elif response["status"] == "failed" or response["status"]== "expired":
-            # TODO: re-submit the batch using the same batch file
-            print(f"ERR IN BATCH ID: {response['id']}")
-            continue
+    file_path = folder / f"{unique_id}_batch_results.jsonl"
+    try:
+        # once fetched it will not be available anymore, so a retry after a failed write reuses the stored copy
+        stored = artifacts.find(kind="results", file_id=output_file_id)
+        if stored:
+            file_path = stored[0]
         else:
-            print(f"BATH ID: {response['status']}")
-            continue
+            if not file_path.exists():
+                with metrics.timer("groq_results_download"):
+                    response = groq_client.files.content(output_file_id)
+                    response.write_to_file(file_path)
+            file_path = artifacts.add(file_path, "results", batch_id=unique_id, file_id=output_file_id)
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: update_channel_database function while fetching processed file form groq or saving file locally -> %s", e)
+        return False
 
-        # if above operation is successful then update batch status to 1
+    channel_ids = batch_channel_ids(input_file)
+    if channel_ids is None:
+        log.warning(f"No input file for batch {unique_id}, channels without a result can't be requeued")
 
-        try:
-            result = collection.update_one(
-                {'batch_id': doc["batch_id"]},
-                {"$set": {"status": 1}}
-            )
-        except Exception as e:
-            print("ERR OCCURRED IN:: update_running_jobs function while updating batch status -> ", e)
-            continue
+    if not ingest_results_file(file_path, channel_ids):
+        return False
+    artifacts.mark_ingested(file_path)
+    return True
 
-        print("Number of batch completed: ", result.matched_count)
-        
-def update_channel_database(output_file_id, unique_id):
+def replay(targets):
     """
-        Takes file path as an input and updates the channel database with the new data.
+    Re-ingest stored result files into the channel database, no groq calls. targets are batch id's,
+    groq output file id's or paths, without targets every stored result that was never ingested.
+    Returns True if everything was written.
     """
+    if targets:
+        paths = []
+        for target in targets:
+            found = artifacts.find(kind="results", batch_id=target) + artifacts.find(kind="results", file_id=target)
+            if not found and Path(target).exists():
+                found = [Path(target)]
+            if not found:
+                log.warning(f"No stored results for {target}")
+            paths.extend(found)
+    else:
+        paths = artifacts.find(kind="results", ingested=False) + artifacts.find(kind="sync_results", ingested=False)
 
-    try:
-        response = groq_client.files.content(output_file_id) # once fetched it will not be available anymore
+    ok = True
+    for path in dict.fromkeys(paths):
+        log.info(f"Replaying {path}")
+        if ingest_results_file(path):
+            artifacts.mark_ingested(path)
+        else:
+            ok = False
+    return ok
 
-        file_path = folder / f"{unique_id}_batch_results.jsonl"
-        response.write_to_file(file_path)
-    except Exception as e:
-        print("ERR OCCURRED IN:: update_channel_database function while fetching processed file form groq or saving file locally -> ", e)
-        return
+def result_filter(custom_id, content):
+    """
+    Filter for the channel a batch result belongs to. custom_id is the channel _id so the update
+    hits the primary key index, batches written before that used random uuid's and fall back to
+    the llm echoed channel_name.
+    """
+    from bson import ObjectId
+
+    if ObjectId.is_valid(custom_id):
+        return {"_id": ObjectId(custom_id)}
+    return {"channel_name": content.channel_name}
+
+def ingest_results_file(file_path, channel_ids=None):
+    """
+    Stream a batch results file line by line and write the categories to the channel database in
+    bounded unordered bulk writes, memory stays constant regardless of the batch size.
+    channel_ids are the channels the results are for, the ones without a valid result (failed
+    request, invalid output) go back to status 0 once everything else is written.
+    Returns True if every chunk was written.
+    """
+    from pymongo import UpdateOne
 
-    
-    results = []
-    with open(file_path, "r", encoding="utf-8") as f:
+    collection = db["channels"]
+    bulk_ops = []   # (filter, categories) of the pending chunk
+    written = set()
+    parsed = skipped = matched = modified = 0
+    ok = True
+
+    def flush():
+        nonlocal matched, modified, ok
+        # stamped per chunk at write time, the category snapshot reads changes by categorized_at
+        categorized_at = datetime.now().timestamp()
+        operations = [
+            UpdateOne(
+                filter=channel_filter,
+                update={"$set": {"channel_categories": categories, "status": 2, "categorized_at": categorized_at, "categorized_by": "llm"}},
+                upsert=False
+            )
+            for channel_filter, categories in bulk_ops
+        ]
+        try:
+            with metrics.timer("mongo_ingest_write"):
+                result = collection.bulk_write(operations, ordered=False)
+            matched += result.matched_count
+            modified += result.modified_count
+            written.update(channel_filter["_id"] for channel_filter, _ in bulk_ops if "_id" in channel_filter)
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: update_channel_database function while batch inserting categories -> %s", e)
+            ok = False
+        bulk_ops.clear()
+
+    with open_artifact(file_path) as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
+
             try:
-                obj = json.loads(line)
-                results.append(obj)
-            except json.JSONDecodeError as e:
-                print("Skipping bad line:", e)
+                result = json.loads(line)
+                parsed += 1
+                content_raw = result["response"]["body"]["choices"][0]["message"]["content"]
+                content = result_model().model_validate_json(content_raw)
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: update_channel_database function while validating result %s -> %s", line[:80], e)
+                skipped += 1
+                continue
 
-    print(f"Parsed {len(results)} records")
+            bulk_ops.append((result_filter(result.get("custom_id"), content), content.categories))
+            if len(bulk_ops) >= INGEST_CHUNK_SIZE:
+                flush()
 
-    # can be used to validate results
-    class ChannelCategoryAnalysis(BaseModel):
-        channel_name: str = Field(description="The name of the YouTube channel")
-        categories: List[int] = Field(
-            min_length=1,
-            max_length=3,
-            description="Array of category integers (0-9)"
-        )
+    if bulk_ops:
+        flush()
+
+    log.info(f"Parsed {parsed} records, skipped {skipped}, Matched: {matched}, Modified: {modified}")
+    metrics.inc("ingest_parsed", parsed)
+    metrics.inc("ingest_skipped", skipped)
+    metrics.inc("ingest_matched", matched)
+    metrics.inc("ingest_modified", modified)
+    if not parsed:
+        log.info("No valid updates found.")
+
+    if ok and channel_ids:
+        missing = [channel_id for channel_id in channel_ids if channel_id not in written]
+        if missing:
+            try:
+                requeued = requeue_channels(missing)
+                log.warning(f"{len(missing)} channels got no valid result, requeued {requeued}")
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: ingest_results_file function while requeuing channels without a result -> %s", e)
+                ok = False
 
-        @field_validator('categories')
-        @classmethod
-        def validate_categories(cls, v):
-            for cat in v:
-                if not (0 <= cat <= 9):
-                    raise ValueError(f'Category {cat} must be between 0 and 9')
-            if len(v) != len(set(v)):
-                raise ValueError('Categories must be unique')
-            return v
+    return ok
+
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT", "1") != "0"
+_snapshot_lock = threading.Lock()
+
+def write_category_snapshot():
+    """Export the categories to the next compact lookup snapshot (see category_snapshot.py), only reads what changed"""
+    if not SNAPSHOT_ENABLED:
+        return
+    from category_snapshot import build
 
     collection = db["channels"]
-    bulk_ops=[]
+    try:
+        collection.create_index([("status", 1), ("categorized_at", 1)])
+        with _snapshot_lock, metrics.timer("snapshot_build"):
+            snapshot, changed = build(collection)
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: write_category_snapshot function while building the snapshot -> %s", e)
+        return
+
+    metrics.inc("snapshot_changed_channels", changed)
+    log.info(f"Category snapshot version {snapshot.version}: {len(snapshot)} channels, {changed} changed")
+
+# Refresh settings, a channel is re-categorized once its upload count drifted from the categorized baseline
+REFRESH_MAX_CHANNELS = int(os.getenv("REFRESH_MAX_CHANNELS", 5000))          # checked per run, 1 quota unit per 50
+REFRESH_MAX_RECATEGORIZE = int(os.getenv("REFRESH_MAX_RECATEGORIZE", 500))   # requeued per run
+REFRESH_MIN_NEW_VIDEOS = int(os.getenv("REFRESH_MIN_NEW_VIDEOS", 10))
+REFRESH_MIN_DRIFT = float(os.getenv("REFRESH_MIN_DRIFT", 0.2))               # new uploads relative to the baseline count
+REFRESH_MIN_AGE_DAYS = float(os.getenv("REFRESH_MIN_AGE_DAYS", 7))           # don't check recently categorized channels
 
-    # TODO: iterate through result and save the result to database in bulk
-    for result in results:
+def get_yt_video_counts(channel_ids):
+    """
+    Current upload count of many channels, statistics part only, one call per 50 id's. Returns (counts
+    keyed by channel id, set of the id's that were looked up). A failed call only loses its own chunk,
+    once the quota runs out the remaining chunks are left for the next run.
+    """
+    counts, looked_up = {}, set()
+    for start in range(0, len(channel_ids), YT_MAX_IDS_PER_CALL):
+        chunk = channel_ids[start:start + YT_MAX_IDS_PER_CALL]
         try:
-            content_raw = result["response"]["body"]["choices"][0]["message"]["content"]
-            content_json = json.loads(content_raw)
-            validated_result = ChannelCategoryAnalysis(**content_json)
-            print("Success:")
-            print(validated_result.model_dump_json(indent=2))
-        except json.JSONDecodeError:
-            # if it's not valid JSON, just keep it as string
-            continue
+            response = yt_execute(youtube.channels().list(part='statistics', id=",".join(chunk), maxResults=YT_MAX_IDS_PER_CALL))
+        except QuotaExhausted:
+            log.warning("YOUTUBE QUOTA EXHAUSTED, refresh checks the remaining channels next run")
+            break
         except Exception as e:
-            print("ERR OCCURRED IN:: update_channel_database function while iterating through each channel categories -> ", e)
+            log.error("ERR OCCURRED IN:: get_yt_video_counts function while fetching channel statistics -> %s", e)
             continue
 
-        try:
+        looked_up.update(chunk)
+        for item in response.get('items', []):
+            try:
+                counts[item['id']] = int(item['statistics']['videoCount'])
+            except (KeyError, ValueError):
+                pass
+    return counts, looked_up
 
-            channel_name = content_json["channel_name"]     # filter the doc
-            categories = content_json["categories"]         # update the categories field in doc
+def drift_score(stored_count, current_count, age_days):
+    """
+    How much a channel's content moved since it was categorized, 0 if not materially. New uploads
+    relative to the baseline count, weighted up by the time since categorization.
+    """
+    new_videos = current_count - stored_count
+    drift = new_videos / max(stored_count, 1)
+    if new_videos < REFRESH_MIN_NEW_VIDEOS or drift < REFRESH_MIN_DRIFT:
+        return 0.0
+    return drift * (1 + age_days / 30)
 
-            if not channel_name or not isinstance(categories, list):
-                print("ERR IN LLM OUTPUT FORMAT:: channel_name not string or categories not list")
-                continue 
+def refresh_categories():
+    """
+    Find categorized channels whose content changed and send them through the pipeline again.
 
-            bulk_ops.append(
-                UpdateOne(
-                    filter={"channel_name": channel_name},        
-                    update={"$set": {"channel_categories": categories, "status": 2}},
-                    upsert=False                                 
-                )
-            )
+    The least recently checked status 2 channels are looked up with statistics only (50 per quota
+    unit) and their upload count compared with the count stored when they were categorized. The
+    REFRESH_MAX_RECATEGORIZE channels that drifted most (scaled by age) go back to status 0, the next
+    execute_new_jobs only fetches their new uploads (latest_video is kept) and re-runs the llm.
+    Categories stay served until the new ones land.
+    """
+    from pymongo import UpdateOne
 
-        except Exception as e:
-            print("ERR OCCURRED IN:: update_channel_database while preparing categories to save to MongoDB -> ", e)
+    collection = db["channels"]
+    now = datetime.now().timestamp()
+
+    try:
+        collection.create_index([("status", 1), ("refresh_checked_at", 1)])
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: refresh_categories function while creating refresh index -> %s", e)
+
+    try:
+        candidates = list(collection.find(
+            {"status": 2, "categorized_at": {"$not": {"$gt": now - REFRESH_MIN_AGE_DAYS * 86400}}},
+            {"channel_handle": 1, "channel_id": 1, "video_count": 1, "categorized_at": 1},
+        ).sort([("refresh_checked_at", 1)]).limit(REFRESH_MAX_CHANNELS))
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: refresh_categories function while reading categorized channels -> %s", e)
+        return
+
+    # channels categorized before the baseline was stored are identified by their handle when it is a channel id
+    def youtube_id(channel):
+        if channel.get("channel_id"):
+            return channel["channel_id"]
+        if not is_handle(channel["channel_handle"]):
+            return channel["channel_handle"].replace('/', '')
+        return None
+
+    ids = sorted({youtube_id(channel) for channel in candidates} - {None})
+    try:
+        counts, looked_up = get_yt_video_counts(ids)
+    finally:
+        yt_quota.release()
+
+    checked, drifted = [], []
+    for channel in candidates:
+        channel_id = youtube_id(channel)
+        current = counts.get(channel_id)
+        if current is None:
             continue
+        checked.append(channel["_id"])
 
-    if bulk_ops:
         try:
-            result = collection.bulk_write(bulk_ops)
-            print(f"Matched: {result.matched_count}, Modified: {result.modified_count}")
+            stored = int(channel.get("video_count"))
+        except (TypeError, ValueError):
+            continue   # no baseline yet, recorded below
+        age_days = (now - (channel.get("categorized_at") or 0)) / 86400
+        score = drift_score(stored, current, age_days)
+        if score > 0:
+            drifted.append((score, channel["_id"]))
+
+    drifted.sort(reverse=True)
+    requeue = {channel_id: position for position, (_, channel_id) in enumerate(drifted[:REFRESH_MAX_RECATEGORIZE])}
+
+    # every looked up candidate counts as checked, also the ones youtube doesn't know (anymore) and the
+    # ones that only have a handle, otherwise they would stay at the head of the refresh order. Those
+    # in a failed (or skipped) call stay there for the next run
+    operations = []
+    for channel in candidates:
+        channel_id = youtube_id(channel)
+        if channel_id is not None and channel_id not in looked_up:
+            continue
+        fields = {"refresh_checked_at": now}
+        if channel_id in counts:
+            fields["channel_id"] = channel_id
+            if not channel.get("video_count"):
+                fields["video_count"] = counts[channel_id]
+        if channel["_id"] in requeue:
+            # behind the demand ranked backlog, most drifted first
+            fields.update({"status": 0, "queue_rank": now + requeue[channel["_id"]]})
+        operations.append(UpdateOne({"_id": channel["_id"], "status": 2}, {"$set": fields}))
+
+    for start in range(0, len(operations), INGEST_CHUNK_SIZE):
+        try:
+            collection.bulk_write(operations[start:start + INGEST_CHUNK_SIZE], ordered=False)
         except Exception as e:
-            print("ERR OCCURRED IN:: update_channel_database function while batch inserting categories -> ", e)
-    else:
-        print("No valid updates found.")
+            log.error("ERR OCCURRED IN:: refresh_categories function while writing refresh results -> %s", e)
+
+    metrics.inc("refresh_checked", len(checked))
+    metrics.inc("refresh_requeued", len(requeue))
+    log.info(f"Refresh checked {len(checked)} of {len(candidates)} channels, {len(drifted)} drifted, requeued {len(requeue)}")
 
 def shutdown_ec2():
     """
         Shutdown the ec2 instance if there are no jobs running.
     """
+    import boto3
     ec2 = boto3.client('ec2')
     url = "http://169.254.169.254/latest/meta-data/instance-id"
 
@@ -499,9 +2187,9 @@ def shutdown_ec2():
         with urllib.request.urlopen(url, timeout=0.3) as response:
             instance_id = response.read().decode('utf-8')
             ec2.stop_instances(InstanceIds=[instance_id])
-            print("STOPPED THE INSTANCE AFTER CRON JOB COMPLETION")
+            log.info("STOPPED THE INSTANCE AFTER CRON JOB COMPLETION")
     except Exception:
-        print("FAILED TO STOPPED THE INSTANCE AFTER CRON JOB COMPLETION")
+        log.warning("FAILED TO STOPPED THE INSTANCE AFTER CRON JOB COMPLETION")
         # send an email/any notification if failed
 
 # TODO: Need to check if valid
@@ -513,12 +2201,253 @@ def is_ec2_instance(timeout=0.1):
     except Exception:
         return False
 
+def parse_shard(value):
+    """'i/n' -> (i, n)"""
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {count})")
+    return index, count
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Categorize new youtube channels and collect finished batches")
+    parser.add_argument("--claim", dest="claim", action="store_true", help="lease pending channels so several workers (and daemons) can run at once (default)")
+    parser.add_argument("--no-claim", dest="claim", action="store_false", help="read pending channels with a plain cursor, only for a single worker without daemons")
+    parser.add_argument("--worker-id", help="lease owner name, defaults to hostname-pid")
+    parser.add_argument("--shard", type=parse_shard, help="only process hash partition i of n, e.g. 0/4 (implies --claim)")
+    parser.add_argument("--migrate-videos", action="store_true", help="one-off: move embedded channel videos to channel_videos and exit")
+    parser.add_argument("--profile-startup", action="store_true", help="report import and client initialization time and exit")
+    parser.add_argument("--replay", nargs="*", metavar="BATCH_ID|FILE_ID|PATH", help="re-ingest stored results (default: all not yet ingested) without calling groq, then exit")
+    parser.add_argument("--refresh", action="store_true", help="requeue categorized channels whose uploads drifted, then exit")
+    parser.add_argument("--daemon", action="store_true", help="keep running: watch for new channels and poll batches on a schedule")
+    parser.set_defaults(claim=True)
+    return parser.parse_args()
+
+# Daemon mode settings
+DAEMON_BATCH_SIZE = int(os.getenv("DAEMON_BATCH_SIZE", 50))              # flush once this many new channels are pending
+DAEMON_WINDOW_SECONDS = int(os.getenv("DAEMON_WINDOW_SECONDS", 120))     # or once the oldest pending one waited this long
+DAEMON_SCAN_SECONDS = int(os.getenv("DAEMON_SCAN_SECONDS", 30))          # polling fallback interval without change streams
+DAEMON_BATCH_POLL_SECONDS = int(os.getenv("DAEMON_BATCH_POLL_SECONDS", 300))
+
+class MicroBatcher:
+    """Counts newly sighted channels and decides when they are worth a flush (size or time window)"""
+
+    def __init__(self, batch_size, window_seconds):
+        self.batch_size = batch_size
+        self.window_seconds = window_seconds
+        self.pending = 0
+        self.first_seen = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def add(self, count=1):
+        with self.lock:
+            if count <= 0:
+                return
+            if self.pending == 0:
+                self.first_seen = time.monotonic()
+            self.pending += count
+            if self.pending >= self.batch_size:
+                self.wakeup.set()
+
+    def due(self):
+        with self.lock:
+            if self.pending == 0:
+                return False
+            return self.pending >= self.batch_size or time.monotonic() - self.first_seen >= self.window_seconds
+
+    def take(self):
+        with self.lock:
+            pending, self.pending, self.first_seen = self.pending, 0, None
+            self.wakeup.clear()
+            return pending
+
+def watch_new_channels(batcher, stop_event):
+    """
+    Feed the micro batcher with inserts of status 0 channels from a change stream. Standalone mongod
+    has no change streams, then the pending backlog is counted every DAEMON_SCAN_SECONDS instead.
+    """
+    from pymongo.errors import OperationFailure, PyMongoError
+
+    collection = db["channels"]
+    pipeline = [{"$match": {"operationType": "insert", "fullDocument.status": 0}}]
+    resume_token = None
+
+    while not stop_event.is_set():
+        try:
+            with collection.watch(pipeline, resume_after=resume_token, max_await_time_ms=1000) as stream:
+                log.info("Watching channels change stream")
+                while not stop_event.is_set() and stream.alive:
+                    change = stream.try_next()
+                    if change is not None:
+                        batcher.add()
+                        metrics.inc("daemon_channels_sighted", source="change_stream")
+                    resume_token = stream.resume_token
+            continue
+        except OperationFailure as e:
+            # 40573: "The $changeStream stage is only supported on replica sets"
+            log.warning("Change streams unavailable (%s), polling for new channels every %ss", e, DAEMON_SCAN_SECONDS)
+        except PyMongoError as e:
+            log.error("ERR OCCURRED IN:: watch_new_channels function while reading change stream -> %s", e)
+            stop_event.wait(5)
+            continue
+
+        # polling fallback, counts channels that are pending and not leased by a worker
+        while not stop_event.is_set():
+            try:
+                now = datetime.now().timestamp()
+                pending = collection.count_documents({"status": 0, **unleased(now)})
+                with batcher.lock:
+                    already = batcher.pending
+                batcher.add(pending - already)
+                metrics.inc("daemon_channels_sighted", max(pending - already, 0), source="poll")
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: watch_new_channels function while polling for new channels -> %s", e)
+            stop_event.wait(DAEMON_SCAN_SECONDS)
+        return
+
+def run_daemon(worker_id=None, shard=None):
+    """
+    Long running mode: new status 0 channels are picked up as they are inserted and processed in
+    micro batches (flushed on DAEMON_BATCH_SIZE or DAEMON_WINDOW_SECONDS, whichever comes first),
+    running batches are polled every DAEMON_BATCH_POLL_SECONDS. Channels are always claimed, cron runs
+    claim by default too, so any number of daemons and cron runs can work side by side (a --no-claim
+    run skips leased channels but its own aren't protected). SIGTERM/SIGINT finish the current flush
+    and poll, then exit.
+    """
+    import signal
+
+    stop_event = threading.Event()
+    batcher = MicroBatcher(DAEMON_BATCH_SIZE, DAEMON_WINDOW_SECONDS)
+
+    def shutdown(signum, frame):
+        log.info("Received signal %s, shutting down after the current work", signum)
+        stop_event.set()
+        batcher.wakeup.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # whatever is already pending gets flushed right away
+    batcher.add(DAEMON_BATCH_SIZE)
+
+    def poll_batches():
+        while not stop_event.is_set():
+            try:
+                update_running_jobs()
+            except Exception as e:
+                log.error("ERR OCCURRED IN:: run_daemon function while polling batches -> %s", e)
+            write_category_snapshot()
+            write_metrics()
+            stop_event.wait(DAEMON_BATCH_POLL_SECONDS)
+
+    workers = [
+        threading.Thread(target=watch_new_channels, args=(batcher, stop_event), name="watcher"),
+        threading.Thread(target=poll_batches, name="poller"),
+    ]
+    for worker in workers:
+        worker.start()
+
+    quota_paused = False
+    while not stop_event.is_set():
+        batcher.wakeup.wait(timeout=1)
+        if stop_event.is_set() or not batcher.due():
+            continue
+
+        # a flush would only claim channels it can't fetch, wait for the quota day to roll over
+        if yt_quota.is_exhausted():
+            if not quota_paused:
+                log.warning("YOUTUBE QUOTA EXHAUSTED, new channels wait until the quota resets")
+                quota_paused = True
+            stop_event.wait(60)
+            continue
+        quota_paused = False
+
+        pending = batcher.take()
+        log.info("Flushing micro batch of %s new channels", pending)
+        metrics.inc("daemon_flushes")
+        try:
+            execute_new_jobs(claim=True, worker_id=worker_id, shard=shard)
+        except Exception as e:
+            log.error("ERR OCCURRED IN:: run_daemon function while processing new channels -> %s", e)
+        write_category_snapshot()
+        write_metrics()
+
+    for worker in workers:
+        worker.join()
+    log.info("Daemon stopped")
+
+def profile_startup():
+    """Import time of this module plus the time each lazily built client takes on first use"""
+    report = {"import_s": round(_import_seconds, 4)}
+    for lazy in (groq_client, youtube, client, db):
+        try:
+            lazy.get()
+            report[f"{lazy.name}_init_s"] = round(lazy.init_seconds, 4)
+        except Exception as e:
+            report[f"{lazy.name}_init_s"] = f"failed: {e}"
+
+    started = time.perf_counter()
+    result_model()
+    report["result_model_s"] = round(time.perf_counter() - started, 4)
+    print(json.dumps(report, indent=2))
+
+METRICS_JSON = os.getenv("METRICS_JSON", str(folder / "metrics.json"))
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", str(folder / "shutup.prom"))
+
+def write_metrics():
+    """Machine readable run summary: json report plus prometheus textfile"""
+    try:
+        metrics.write(METRICS_JSON, METRICS_TEXTFILE)
+        log.info("Wrote run metrics", extra={"json": METRICS_JSON, "textfile": METRICS_TEXTFILE})
+    except Exception as e:
+        log.error("ERR OCCURRED IN:: write_metrics function while writing metrics -> %s", e)
+
+_import_seconds = time.perf_counter() - _import_started
+
 if __name__ == "__main__":
+    args = parse_args()
+    setup_logging()
+
+    if args.profile_startup:
+        profile_startup()
+        raise SystemExit(0)
+
+    if args.migrate_videos:
+        migrate_videos()
+        client.close()
+        raise SystemExit(0)
+
+    if args.replay is not None:
+        ok = replay(args.replay)
+        write_category_snapshot()
+        client.close()
+        artifacts.close()
+        raise SystemExit(0 if ok else 1)
+
+    if args.refresh:
+        refresh_categories()
+        write_metrics()
+        client.close()
+        raise SystemExit(0)
+
+    if args.daemon:
+        run_daemon(worker_id=args.worker_id, shard=args.shard)
+        write_metrics()
+        if client.initialized:
+            client.close()
+        if yt_cache is not None:
+            yt_cache.close()
+        artifacts.close()
+        raise SystemExit(0)
+
     # TODO: run two separate threads for both of them
     # execute_new_jobs()
     # update_running_jobs()
 
-    new_job_thread = threading.Thread(target=execute_new_jobs)
+    new_job_thread = threading.Thread(
+        target=execute_new_jobs,
+        kwargs={"claim": args.claim or args.shard is not None, "worker_id": args.worker_id, "shard": args.shard}
+    )
     update_job_thread = threading.Thread(target=update_running_jobs)
     new_job_thread.start()
     update_job_thread.start()
@@ -527,10 +2456,17 @@ if __name__ == "__main__":
     new_job_thread.join()
     update_job_thread.join()
 
+    write_category_snapshot()
+    write_metrics()
+
     # closing database connections 
-    client.close()
+    if client.initialized:
+        client.close()
+    if yt_cache is not None:
+        yt_cache.close()
+    artifacts.close()
 
     if is_ec2_instance():
-        print("SHUTTING DOWN EC2 INSTANCE")
+        log.info("SHUTTING DOWN EC2 INSTANCE")
         shutdown_ec2()
     
\ No newline at end of file